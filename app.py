@@ -2,14 +2,28 @@
 # Guarita - Controle de Chaves
 # (Acesso público restrito + Autorizações + Categorias + Atraso 23h + QR Retirada/Devolução + Token)
 # ==========================================
-import os, io, uuid, sqlite3, datetime, zipfile, secrets, string
-from typing import Optional, Tuple, List
+import os, io, datetime, zipfile
+from typing import Optional, List
 import pandas as pd
 import streamlit as st
 from PIL import Image
 from streamlit_drawable_canvas import st_canvas
 import qrcode
-import sqlite3 as _sqlite3  # capturar IntegrityError
+from db import (
+    CUTOFF_HOUR_FOR_OVERDUE, TOKEN_TTL_MINUTES, BATCH_MAX_KEYS,
+    conn, writer_stats, start_overdue_monitor, list_overdue,
+    add_space, list_spaces, update_space, space_exists_and_active,
+    add_person, list_persons, update_person,
+    add_authorization, list_authorizations, add_person_to_authorization, list_authorized_people_now,
+    create_qr_token, validate_qr_token,
+    open_checkout, do_checkin, list_status, list_transactions, usage_rollup, search_transactions,
+    qr_checkout_person, qr_checkin, qr_checkout,
+    batch_checkout, batch_checkin, qr_batch_checkout, qr_batch_checkin,
+    SITE_NAME, list_sites, list_status_all_sites, list_transactions_all_sites,
+    current_cursor, changes_since,
+    backup_now, list_backups, backup_status, start_backup_scheduler,
+    storage_report, migration_report,
+)
 
 # -------------- Configurações --------------
 st.set_page_config(page_title="SIGA-Chaves - Guarita Rondon", layout="wide")
@@ -17,20 +31,26 @@ APP_TITLE = "SIGA-Chaves - Guarita Rondon"
 
 ADMIN_PASS = st.secrets.get("STREAMLIT_ADMIN_PASS", os.getenv("STREAMLIT_ADMIN_PASS", ""))
 SECRET_BASE_URL = st.secrets.get("BASE_URL", os.getenv("BASE_URL", "")).strip()
-DB_PATH = os.getenv("DB_PATH", "keys.db")
-CUTOFF_HOUR_FOR_OVERDUE = int(os.getenv("CUTOFF_HOUR_FOR_OVERDUE", "23"))  # atraso até 23:00
-TOKEN_TTL_MINUTES = int(os.getenv("TOKEN_TTL_MINUTES", "30"))  # validade padrão do token
-QR_CHECK_AUTH_ON_CHECKOUT = os.getenv("QR_CHECK_AUTH_ON_CHECKOUT", "false").lower() == "true" # false (não exige autorização no QR de retirada).
+BOARD_REFRESH_S = int(os.getenv("BOARD_REFRESH_S", "5"))  # intervalo do painel ao vivo (?board=1)
+SCAN_BASE_URL = st.secrets.get("SCAN_BASE_URL", os.getenv("SCAN_BASE_URL", "")).strip()  # scan_api.py (opcional)
+# DB_PATH, CUTOFF_HOUR_FOR_OVERDUE, TOKEN_TTL_MINUTES e QR_CHECK_AUTH_ON_CHECKOUT: ver db.py
+start_overdue_monitor()  # idempotente: uma thread por processo
+start_backup_scheduler()  # só se BACKUP_INTERVAL_MIN > 0
 
 # -------------- Utilidades -----------------
-def now_iso():
-    return datetime.datetime.now().isoformat(timespec="seconds")
-
 def to_png_bytes(img: Image.Image) -> bytes:
     buf = io.BytesIO()
     img.save(buf, format="PNG"); buf.seek(0)
     return buf.read()
 
+def canvas_png(canvas) -> Optional[bytes]:
+    if canvas.image_data is None:
+        return None
+    try:
+        return to_png_bytes(Image.fromarray((canvas.image_data).astype("uint8")))
+    except Exception:
+        return None
+
 def make_qr(data: str) -> Image.Image:
     qr = qrcode.QRCode(version=2, box_size=8, border=2)
     qr.add_data(data); qr.make(fit=True)
@@ -43,327 +63,6 @@ def build_url(base_url: str, params: dict) -> str:
     query = "&".join(f"{k}={v}" for k, v in params.items() if v is not None and v != "")
     return f"{base}/?{query}" if query else f"{base}/"
 
-def gen_token_str(n: int = 24) -> str:
-    alphabet = string.ascii_letters + string.digits
-    return ''.join(secrets.choice(alphabet) for _ in range(n))
-
-# -------------- Banco de Dados -------------
-def conn():
-    c = sqlite3.connect(DB_PATH)
-    c.execute("""PRAGMA foreign_keys = ON;""")
-    # spaces (+ category)
-    c.execute("""
-      CREATE TABLE IF NOT EXISTS spaces(
-        key_number INTEGER PRIMARY KEY,
-        room_name  TEXT NOT NULL,
-        location   TEXT,
-        is_active  INTEGER DEFAULT 1
-      )
-    """)
-    try:
-        c.execute("ALTER TABLE spaces ADD COLUMN category TEXT DEFAULT 'Sala'")
-    except Exception:
-        pass
-
-    # persons
-    c.execute("""
-      CREATE TABLE IF NOT EXISTS persons(
-        id TEXT PRIMARY KEY,
-        name TEXT NOT NULL,
-        id_code TEXT,
-        phone TEXT,
-        is_active INTEGER DEFAULT 1
-      )
-    """)
-
-    # transactions
-    c.execute("""
-      CREATE TABLE IF NOT EXISTS transactions(
-        id TEXT PRIMARY KEY,
-        key_number INTEGER NOT NULL,
-        taken_by_name TEXT NOT NULL,
-        taken_by_id   TEXT,
-        taken_phone   TEXT,
-        checkout_time TEXT NOT NULL,
-        due_time      TEXT,
-        checkin_time  TEXT,
-        status        TEXT,             -- EM_USO / DEVOLVIDA
-        signature_out BLOB,
-        signature_in  BLOB,
-        FOREIGN KEY (key_number) REFERENCES spaces(key_number)
-      )
-    """)
-
-    # authorizations
-    c.execute("""
-      CREATE TABLE IF NOT EXISTS authorizations(
-        id TEXT PRIMARY KEY,
-        key_number INTEGER NOT NULL,
-        memo_number TEXT,
-        valid_from TEXT,
-        valid_to   TEXT,
-        created_at TEXT,
-        FOREIGN KEY (key_number) REFERENCES spaces(key_number)
-      )
-    """)
-    c.execute("""
-      CREATE TABLE IF NOT EXISTS authorization_people(
-        id TEXT PRIMARY KEY,
-        authorization_id TEXT NOT NULL,
-        person_id TEXT NOT NULL,
-        FOREIGN KEY (authorization_id) REFERENCES authorizations(id),
-        FOREIGN KEY (person_id) REFERENCES persons(id)
-      )
-    """)
-
-    # qr_tokens (uso único)
-    c.execute("""
-      CREATE TABLE IF NOT EXISTS qr_tokens(
-        token TEXT PRIMARY KEY,
-        action TEXT NOT NULL,         -- 'retirar' | 'devolver'
-        key_number INTEGER NOT NULL,
-        person_id TEXT,               -- opcional (obrigatório para retirar personalizada)
-        expires_at TEXT NOT NULL,
-        used_at TEXT,
-        created_at TEXT NOT NULL,
-        FOREIGN KEY (key_number) REFERENCES spaces(key_number),
-        FOREIGN KEY (person_id) REFERENCES persons(id)
-      )
-    """)
-    return c
-
-# ----- Helpers: Spaces -----
-def add_space(key_number: int, room_name: str, location: str = "", category: str = "Sala"):
-    c = conn()
-    with c:
-        c.execute("""INSERT OR REPLACE INTO spaces(key_number,room_name,location,is_active,category)
-                     VALUES(?,?,?,?,?)""", (key_number, room_name, location, 1, category))
-
-def list_spaces(active_only=True):
-    c = conn()
-    if active_only:
-        return pd.read_sql_query("SELECT * FROM spaces WHERE is_active=1 ORDER BY key_number", c)
-    return pd.read_sql_query("SELECT * FROM spaces ORDER BY key_number", c)
-
-def update_space(key_number: int, room_name: str, location: str, is_active: int, category: str = "Sala"):
-    c = conn()
-    with c:
-        c.execute("""UPDATE spaces SET room_name=?, location=?, is_active=?, category=? WHERE key_number=?""",
-                  (room_name, location, int(is_active), category, key_number))
-
-def space_exists_and_active(key_number: int) -> bool:
-    c = conn()
-    cur = c.cursor()
-    cur.execute("SELECT 1 FROM spaces WHERE key_number=? AND is_active=1", (key_number,))
-    return cur.fetchone() is not None
-
-# ----- Helpers: Persons -----
-def add_person(name: str, id_code: str = "", phone: str = ""):
-    c = conn()
-    with c:
-        c.execute("INSERT INTO persons(id,name,id_code,phone,is_active) VALUES(?,?,?,?,1)",
-                  (str(uuid.uuid4()), name, id_code, phone))
-
-def list_persons(active_only=True):
-    c = conn()
-    if active_only:
-        return pd.read_sql_query("SELECT * FROM persons WHERE is_active=1 ORDER BY name", c)
-    return pd.read_sql_query("SELECT * FROM persons ORDER BY name", c)
-
-def update_person(pid: str, name: str, id_code: str, phone: str, is_active: int):
-    c = conn()
-    with c:
-        c.execute("UPDATE persons SET name=?, id_code=?, phone=?, is_active=? WHERE id=?",
-                  (name, id_code, phone, int(is_active), pid))
-
-def get_person(pid: str) -> Optional[pd.Series]:
-    df = list_persons(active_only=False)
-    if df.empty: return None
-    row = df[df["id"] == pid]
-    return None if row.empty else row.iloc[0]
-
-# ----- Helpers: Autorizações -----
-def add_authorization(key_number:int, memo_number:str, valid_from:Optional[datetime.date], valid_to:Optional[datetime.date]) -> str:
-    c = conn(); aid = str(uuid.uuid4())
-    with c:
-        c.execute("""INSERT INTO authorizations(id,key_number,memo_number,valid_from,valid_to,created_at)
-                     VALUES(?,?,?,?,?,?)""",
-                  (aid, key_number, memo_number,
-                   datetime.datetime.combine(valid_from, datetime.time.min).isoformat(timespec="seconds") if valid_from else None,
-                   datetime.datetime.combine(valid_to,   datetime.time.max).isoformat(timespec="seconds") if valid_to   else None,
-                   now_iso()))
-    return aid
-
-def list_authorizations(key_number:int=None) -> pd.DataFrame:
-    c = conn()
-    q = "SELECT * FROM authorizations"; p = []
-    if key_number is not None:
-        q += " WHERE key_number=?"; p.append(key_number)
-    q += " ORDER BY created_at DESC"
-    return pd.read_sql_query(q, c, params=p)
-
-def add_person_to_authorization(authorization_id:str, person_id:str):
-    c = conn()
-    with c:
-        c.execute("""INSERT INTO authorization_people(id,authorization_id,person_id)
-                     VALUES(?,?,?)""", (str(uuid.uuid4()), authorization_id, person_id))
-
-def list_authorized_people_now(key_number:int) -> pd.DataFrame:
-    c = conn()
-    now = now_iso()
-    q = """
-    SELECT p.*
-    FROM persons p
-    JOIN authorization_people ap ON ap.person_id = p.id
-    JOIN authorizations a ON a.id = ap.authorization_id
-    WHERE a.key_number = ?
-      AND (a.valid_from IS NULL OR datetime(a.valid_from) <= datetime(?))
-      AND (a.valid_to   IS NULL OR datetime(a.valid_to)   >= datetime(?))
-      AND p.is_active = 1
-    """
-    return pd.read_sql_query(q, c, params=[key_number, now, now])
-
-# ----- Helpers: Tokens -----
-def create_qr_token(action: str, key_number: int, person_id: Optional[str], ttl_minutes: int = TOKEN_TTL_MINUTES) -> Tuple[str, datetime.datetime]:
-    assert action in ("retirar", "devolver")
-    token = gen_token_str(28)
-    exp = datetime.datetime.now() + datetime.timedelta(minutes=int(ttl_minutes))
-    c = conn()
-    with c:
-        c.execute("""INSERT INTO qr_tokens(token, action, key_number, person_id, expires_at, used_at, created_at)
-                     VALUES(?,?,?,?,?,?,?)""",
-                  (token, action, key_number, person_id, exp.isoformat(timespec="seconds"), None, now_iso()))
-    return token, exp
-
-def validate_qr_token(token: str, action: str, key_number: int, person_id: Optional[str] = None) -> Tuple[bool, str]:
-    """Valida sem consumir; retorna (ok, msg_erro)."""
-    c = conn()
-    cur = c.cursor()
-    cur.execute("""SELECT action, key_number, person_id, expires_at, used_at FROM qr_tokens WHERE token=?""", (token,))
-    row = cur.fetchone()
-    if not row:
-        return False, "Token inválido."
-    act, keyn, pid, exp, used = row
-    if act != action:
-        return False, "Token não corresponde a esta operação."
-    if int(keyn) != int(key_number):
-        return False, "Token não corresponde a esta chave."
-    if person_id is not None and pid != person_id:
-        return False, "Token não corresponde à pessoa autorizada."
-    try:
-        if used is not None:
-            return False, "Token já utilizado."
-        if datetime.datetime.now() > datetime.datetime.fromisoformat(str(exp)):
-            return False, "Token expirado."
-    except Exception:
-        return False, "Falha ao validar o token."
-    return True, ""
-
-def consume_qr_token(token: str):
-    c = conn()
-    with c:
-        c.execute("UPDATE qr_tokens SET used_at=? WHERE token=? AND used_at IS NULL", (now_iso(), token))
-
-# ----- Operação / Transactions -----
-def has_open_checkout(key_number: int) -> bool:
-    c = conn()
-    cur = c.cursor()
-    cur.execute("""SELECT 1 FROM transactions 
-                   WHERE key_number=? AND checkin_time IS NULL
-                   LIMIT 1""", (key_number,))
-    return cur.fetchone() is not None
-
-def open_checkout(key_number: int, name: str, id_code: str, phone: str,
-                  due_time: Optional[datetime.datetime], signature_png: Optional[bytes]) -> Tuple[bool, str]:
-    if not space_exists_and_active(key_number):
-        return False, f"A chave {key_number} não está cadastrada como ATIVA. Cadastre/ative em Cadastros → Espaços."
-    name = (name or "").strip()
-    if not name:
-        return False, "Informe o nome de quem está retirando a chave."
-    if has_open_checkout(key_number):
-        return False, "Esta chave já está EM USO. Faça a devolução antes de nova retirada."
-    c = conn()
-    tid = str(uuid.uuid4())
-    try:
-        with c:
-            c.execute("""INSERT INTO transactions
-                         (id,key_number,taken_by_name,taken_by_id,taken_phone,checkout_time,due_time,checkin_time,status,signature_out,signature_in)
-                         VALUES(?,?,?,?,?,?,?,?,?,?,?)""",
-                      (tid, key_number, name, (id_code or "").strip(), (phone or "").strip(),
-                       now_iso(),
-                       due_time.isoformat(timespec="seconds") if due_time else None,
-                       None, "EM_USO", signature_png, None))
-        return True, tid
-    except _sqlite3.IntegrityError:
-        return False, "Não foi possível registrar a retirada. Verifique se a chave existe/está ativa e os campos obrigatórios."
-
-def do_checkin(key_number: int, signature_png: Optional[bytes]) -> Tuple[bool, str]:
-    if not space_exists_and_active(key_number):
-        return False, f"A chave {key_number} não está cadastrada/ativa. Cadastre/ative em Cadastros → Espaços."
-    c = conn()
-    cur = c.cursor()
-    cur.execute("""SELECT id FROM transactions 
-                   WHERE key_number=? AND checkin_time IS NULL
-                   ORDER BY checkout_time DESC LIMIT 1""", (key_number,))
-    row = cur.fetchone()
-    if not row:
-        return False, "Não há retirada em aberto para esta chave."
-    tid = row[0]
-    with c:
-        c.execute("""UPDATE transactions SET checkin_time=?, status=?, signature_in=? WHERE id=?""",
-                  (now_iso(), "DEVOLVIDA", signature_png, tid))
-    return True, tid
-
-def list_status() -> pd.DataFrame:
-    c = conn()
-    df_space = list_spaces(active_only=True)  # inclui category
-    df_tx = pd.read_sql_query("""
-        SELECT t.key_number, t.checkout_time, t.due_time, t.checkin_time, t.status AS last_status
-        FROM transactions t
-        INNER JOIN (
-          SELECT key_number, MAX(checkout_time) AS max_co FROM transactions GROUP BY key_number
-        ) m ON t.key_number=m.key_number AND t.checkout_time=m.max_co
-    """, c)
-    df = df_space.merge(df_tx, on="key_number", how="left")
-
-    def compute_status(row):
-        if pd.isna(row["checkout_time"]):
-            return "DISPONÍVEL"
-        if pd.isna(row["checkin_time"]):
-            now = datetime.datetime.now()
-            if pd.notna(row["due_time"]):
-                try:
-                    due = datetime.datetime.fromisoformat(str(row["due_time"]))
-                    if now > due:
-                        return "ATRASADA"
-                except Exception:
-                    pass
-            try:
-                co = datetime.datetime.fromisoformat(str(row["checkout_time"]))
-                limit = co.replace(hour=CUTOFF_HOUR_FOR_OVERDUE, minute=0, second=0, microsecond=0)
-                if limit < co: limit = limit + datetime.timedelta(days=1)
-                if now > limit: return "ATRASADA"
-            except Exception:
-                pass
-            return "EM_USO"
-        return "DISPONÍVEL"
-
-    df["status"] = df.apply(compute_status, axis=1)
-    return df[["key_number","room_name","location","category","status","checkout_time","due_time","checkin_time"]].sort_values("key_number")
-
-def list_transactions(start: Optional[datetime.datetime] = None,
-                      end: Optional[datetime.datetime] = None) -> pd.DataFrame:
-    c = conn()
-    base_q = "SELECT * FROM transactions"; params: List[str] = []; where = []
-    if start:
-        where.append("datetime(checkout_time) >= datetime(?)"); params.append(start.isoformat(timespec="seconds"))
-    if end:
-        where.append("datetime(COALESCE(checkin_time, checkout_time)) <= datetime(?)"); params.append(end.isoformat(timespec="seconds"))
-    if where:
-        base_q += " WHERE " + " AND ".join(where)
-    base_q += " ORDER BY checkout_time DESC"
-    return pd.read_sql_query(base_q, c, params=params)
-
 # -------------- Header & Sidebar -------------
 st.title(APP_TITLE)
 
@@ -378,6 +77,11 @@ with st.sidebar:
         st.caption("Modo público: sem operações; relatórios e devolução/retirada apenas via QR com token.")
     else:
         st.info("Nenhuma senha configurada. Defina STREAMLIT_ADMIN_PASS em Secrets (produção).")
+    if is_admin:
+        with st.expander("Banco de dados (fila de escrita)"):
+            ws = writer_stats()
+            st.caption(f"Escritas: {ws['writes']} • {ws['writes_per_s']}/s • fila: {ws['queued']} • erros: {ws['errors']}")
+            st.caption(f"Tempo médio: escrita {ws['avg_write_ms']} ms • espera {ws['avg_wait_ms']} ms • ocupação {ws['utilization']:.1%}")
 
 with st.sidebar:
     st.header("Configuração de QR")
@@ -387,8 +91,12 @@ with st.sidebar:
     else:
         base_url = st.text_input("Base URL (para QRs)", value="http://localhost:8501", key="qr_base_url",
                                  help="Defina BASE_URL em Secrets para fixar permanentemente.")
+    # QRs de retirada/devolução apontam para a página leve do scan_api.py, se configurada
+    scan_url = SCAN_BASE_URL or base_url
+    if SCAN_BASE_URL:
+        st.caption(f"SCAN_BASE_URL (QRs de operação): {scan_url}")
 
-# Query params (?key=12&action=devolver|retirar&pid=<person_id>&token=...)
+# Query params (?key=12&action=devolver|retirar&pid=<person_id>&token=...; lote: ?keys=12,13,14&...)
 qp = st.query_params
 def _get1(x):
     return x[0] if isinstance(x, list) else x
@@ -396,12 +104,43 @@ qp_key    = _get1(qp.get("key"))
 qp_action = _get1(qp.get("action"))
 qp_pid    = _get1(qp.get("pid"))
 qp_token  = _get1(qp.get("token"))
+qp_keys   = [int(k) for k in str(_get1(qp.get("keys")) or "").split(",") if k.strip().isdigit()]
 
 if qp_action not in ("retirar", "devolver", "info"):
     qp_action = None
 
-public_qr_return  = (not is_admin) and (qp_action == "devolver") and qp_key and str(qp_key).isdigit()
-public_qr_checkout = (not is_admin) and (qp_action == "retirar")  and qp_key and str(qp_key).isdigit() and qp_pid
+# -------------- PAINEL AO VIVO (?board=1) ---
+def render_live_board():
+    """Painel de parede: carrega o status uma vez e depois só aplica as chaves
+    que aparecem no change_log desde o último cursor."""
+    ss = st.session_state
+    if "board_df" not in ss:
+        ss.board_cursor = current_cursor()
+        ss.board_df = list_status(from_snapshot=True).set_index("key_number")
+    else:
+        cursor, changes, reload_all = changes_since(ss.board_cursor)
+        keys = changes["key_number"].dropna().astype(int).unique().tolist()
+        if reload_all:  # cursor anterior à poda do change_log
+            ss.board_df = list_status(from_snapshot=True).set_index("key_number")
+        elif keys:
+            fresh = list_status(keys=keys, from_snapshot=True).set_index("key_number")  # inclui novas/desativadas
+            ss.board_df = pd.concat([ss.board_df.drop(index=keys, errors="ignore"), fresh]).sort_index()
+        ss.board_cursor = cursor
+    df = ss.board_df
+    m1, m2, m3 = st.columns(3)
+    m1.metric("Disponíveis", int((df["status"] == "DISPONÍVEL").sum()))
+    m2.metric("Em uso", int((df["status"] == "EM_USO").sum()))
+    m3.metric("Atrasadas", int((df["status"] == "ATRASADA").sum()))
+    st.dataframe(df[["room_name","location","category","status","due_time"]], use_container_width=True, height=720)
+    st.caption(f"Atualizado {datetime.datetime.now().strftime('%H:%M:%S')} • cursor {ss.board_cursor}")
+
+if _get1(qp.get("board")) == "1":
+    st.subheader("Painel ao vivo")
+    st.fragment(run_every=BOARD_REFRESH_S)(render_live_board)()
+    st.stop()
+
+public_qr_return  = (not is_admin) and (qp_action == "devolver") and ((qp_key and str(qp_key).isdigit()) or qp_keys)
+public_qr_checkout = (not is_admin) and (qp_action == "retirar")  and ((qp_key and str(qp_key).isdigit()) or qp_keys) and qp_pid
 
 # -------------- Abas principais --------------
 if is_admin:
@@ -422,13 +161,18 @@ if is_admin:
         st.subheader("Status das chaves")
         cats = ["Todas", "Sala", "Laboratório", "Secretaria"]
         sel_cat = st.selectbox("Filtrar por categoria", cats, index=0, key="op_cat")
-        df_status = list_status()
+        df_status = list_status(from_snapshot=True)  # ATRASADA = snapshot do monitor
         if sel_cat != "Todas":
             df_status = df_status[df_status["category"] == sel_cat]
         st.dataframe(df_status, use_container_width=True)
         num_atraso = (df_status["status"] == "ATRASADA").sum()
         if num_atraso:
             st.error(f"⚠️ {num_atraso} chave(s) ATRASADA(s).")
+        df_overdue = list_overdue()
+        if not df_overdue.empty:
+            with st.expander(f"Atrasadas desde (monitor): {len(df_overdue)}"):
+                st.dataframe(df_overdue[["key_number","room_name","taken_by_name","overdue_since","detected_at"]],
+                             use_container_width=True)
 
         st.markdown("---")
         st.subheader("Retirar / Devolver (Gestor)")
@@ -455,8 +199,8 @@ if is_admin:
 
         # Dados do responsável
         prefilled = None
-        if qp_pid and not df_persons.empty and (df_persons["id"] == qp_pid).any():
-            prow = df_persons[df_persons["id"] == qp_pid].iloc[0]
+        if qp_pid and not df_persons.empty and (df_persons["uid"] == qp_pid).any():
+            prow = df_persons[df_persons["uid"] == qp_pid].iloc[0]
             prefilled = {"name": prow["name"], "id_code": prow["id_code"], "phone": prow["phone"]}
 
         st.markdown("**Dados do responsável**")
@@ -507,13 +251,7 @@ if is_admin:
             col_g, col_t = st.columns([1,1])
             with col_g:
                 if st.button("Confirmar retirada", key="btn_checkout"):
-                    sig_bytes = None
-                    if canvas_out.image_data is not None:
-                        try:
-                            img = Image.fromarray((canvas_out.image_data).astype("uint8"))
-                            buf = io.BytesIO(); img.save(buf, format="PNG"); sig_bytes = buf.getvalue()
-                        except Exception:
-                            sig_bytes = None
+                    sig_bytes = canvas_png(canvas_out)
                     ok, msg = open_checkout(int(key_number), taken_by_name, taken_by_id, taken_by_phone, due_time, sig_bytes)
                     if ok: st.success(f"Chave {int(key_number)} entregue. Protocolo: {msg}")
                     else:  st.error(msg)
@@ -530,14 +268,14 @@ if is_admin:
                     st.info("Cadastre pessoas para gerar QR de retirada.")
                 else:
                     sel_p_for_qr = st.selectbox("Pessoa", options=dfp_all["name"].tolist(), key="qr_checkout_person_admin")
-                    pid_val2 = dfp_all[dfp_all["name"] == sel_p_for_qr].iloc[0]["id"]
+                    pid_val2 = dfp_all[dfp_all["name"] == sel_p_for_qr].iloc[0]["uid"]
                     # checa autorização vigente opcional
                     df_auth_now = list_authorized_people_now(int(key_number))
-                    if not df_auth_now.empty and not (df_auth_now["id"] == pid_val2).any():
+                    if not df_auth_now.empty and not (df_auth_now["uid"] == pid_val2).any():
                         st.warning("Pessoa não consta autorizada agora para esta chave (cadastre em Autorizações).")
                     if st.button("Gerar QR de Retirada (token único)", key="qr_checkout_make"):
                         token, exp = create_qr_token("retirar", int(key_number), pid_val2, TOKEN_TTL_MINUTES)
-                        url_checkout = build_url(base_url, {"key": int(key_number), "action": "retirar", "pid": pid_val2, "token": token})
+                        url_checkout = build_url(scan_url, {"key": int(key_number), "action": "retirar", "pid": pid_val2, "token": token})
                         img_checkout = make_qr(url_checkout)
                         st.image(img_checkout, use_container_width=False)
                         st.caption(url_checkout)
@@ -553,17 +291,52 @@ if is_admin:
                 background_color="#FFFFFF", height=180, width=500, drawing_mode="freedraw", key="sig_in"
             )
             if st.button("Confirmar devolução", key="btn_checkin"):
-                sig_bytes = None
-                if canvas_in.image_data is not None:
-                    try:
-                        img = Image.fromarray((canvas_in.image_data).astype("uint8"))
-                        buf = io.BytesIO(); img.save(buf, format="PNG"); sig_bytes = buf.getvalue()
-                    except Exception:
-                        sig_bytes = None
+                sig_bytes = canvas_png(canvas_in)
                 ok, msg = do_checkin(int(key_number), sig_bytes)
                 if ok: st.success(f"Chave {int(key_number)} devolvida. Protocolo: {msg}")
                 else:  st.error(msg)
 
+        st.markdown("---")
+        st.subheader("Várias chaves de uma vez (lote)")
+        st.caption(f"Até {BATCH_MAX_KEYS} chaves, uma assinatura. Se alguma chave for recusada, nada é gravado.")
+        modo_lote = st.radio("Ação (lote)", modos, horizontal=True, key="batch_modo")
+        df_all_status = list_status()
+        if modo_lote == "Retirar":
+            batch_opts = df_all_status[df_all_status["status"] == "DISPONÍVEL"]["key_number"].tolist()
+        else:
+            batch_opts = df_all_status[df_all_status["status"] != "DISPONÍVEL"]["key_number"].tolist()
+        batch_keys = st.multiselect("Chaves", options=batch_opts, max_selections=BATCH_MAX_KEYS, key="batch_keys")
+        dfp_batch = list_persons(active_only=True)
+        if modo_lote == "Retirar":
+            if dfp_batch.empty:
+                st.info("Cadastre pessoas para retirar em lote.")
+            else:
+                batch_name = st.selectbox("Responsável", options=dfp_batch["name"].tolist(), key="batch_person")
+                batch_due_choice = st.selectbox("Prazo de devolução", ["Hoje 18:00", "Sem prazo"], key="batch_due")
+                batch_due = (datetime.datetime.combine(datetime.date.today(), datetime.time(18,0))
+                             if batch_due_choice == "Hoje 18:00" else None)
+                canvas_batch_out = st_canvas(
+                    fill_color="rgba(0, 0, 0, 0)", stroke_width=2, stroke_color="#000000",
+                    background_color="#FFFFFF", height=180, width=500, drawing_mode="freedraw", key="sig_batch_out"
+                )
+                if st.button("Confirmar retirada em lote", key="btn_batch_checkout", disabled=not batch_keys):
+                    rowb = dfp_batch[dfp_batch["name"] == batch_name].iloc[0]
+                    ok, results = batch_checkout(batch_keys, rowb["name"], rowb["id_code"], rowb["phone"],
+                                                 batch_due, canvas_png(canvas_batch_out))
+                    if ok: st.success(f"{len(results)} chave(s) entregue(s) a {rowb['name']}.")
+                    else:  st.error("Lote recusado; nenhuma chave foi registrada.")
+                    st.dataframe(pd.DataFrame(results), use_container_width=True)
+        else:
+            canvas_batch_in = st_canvas(
+                fill_color="rgba(0, 0, 0, 0)", stroke_width=2, stroke_color="#000000",
+                background_color="#FFFFFF", height=180, width=500, drawing_mode="freedraw", key="sig_batch_in"
+            )
+            if st.button("Confirmar devolução em lote", key="btn_batch_checkin", disabled=not batch_keys):
+                ok, results = batch_checkin(batch_keys, canvas_png(canvas_batch_in))
+                if ok: st.success(f"{len(results)} chave(s) devolvida(s).")
+                else:  st.error("Lote recusado; nenhuma chave foi registrada.")
+                st.dataframe(pd.DataFrame(results), use_container_width=True)
+
 # -------------- RELATÓRIOS PÚBLICOS ----------
 def render_public_reports():
     st.subheader("Status das chaves")
@@ -579,8 +352,9 @@ def render_public_reports():
 
     st.markdown("---")
     st.subheader("Últimas movimentações")
-    df_tx = list_transactions()
-    cols = ["key_number","taken_by_name","checkout_time","due_time","checkin_time","status"]
+    pub_q = st.text_input("Buscar (nome, sala, nº da chave)", key="pub_search")
+    df_tx = search_transactions(pub_q, public=True) if pub_q.strip() else list_transactions()
+    cols = ["key_number","room_name","taken_by_name","checkout_time","due_time","checkin_time","status"]
     cols = [c for c in cols if c in df_tx.columns]
     st.dataframe(df_tx[cols].head(200), use_container_width=True)
 
@@ -610,17 +384,9 @@ def render_public_qr_return(qkey: int, token: Optional[str]):
         background_color="#FFFFFF", height=180, width=500, drawing_mode="freedraw", key="sig_in_public"
     )
     if st.button("Confirmar devolução", key="btn_checkin_public"):
-        sig_bytes = None
-        if canvas_in.image_data is not None:
-            try:
-                img = Image.fromarray((canvas_in.image_data).astype("uint8"))
-                buf = io.BytesIO(); img.save(buf, format="PNG"); sig_bytes = buf.getvalue()
-            except Exception:
-                sig_bytes = None
-        ok, msg = do_checkin(int(qkey), sig_bytes)
+        sig_bytes = canvas_png(canvas_in)
+        ok, msg = qr_checkin(int(qkey), token, sig_bytes)  # revalida e consome o token (se houver)
         if ok:
-            # consome token (se houver)
-            if token: consume_qr_token(token)
             st.success(f"Chave {int(qkey)} devolvida. Protocolo: {msg}")
         else:
             st.error(msg)
@@ -638,29 +404,10 @@ def render_public_qr_checkout(qkey: int, pid: str, token: Optional[str]):
     if not ok:
         st.error(msg); return
 
-    # Busca pessoa e valida autorização vigente
-    #df_auth_now = list_authorized_people_now(qkey)
-    #if df_auth_now.empty or not (df_auth_now["id"] == pid).any():
-    #    st.error("Você não está autorizado(a) a retirar esta chave neste período.")
-    #    return
-    #prow = df_auth_now[df_auth_now["id"] == pid].iloc[0]
-    # ALTERADO PARA: 
-    # Busca pessoa; política: token pode dispensar autorização vigente
-    # Quando QR_CHECK_AUTH_ON_CHECKOUT = false, o fluxo de QR não barra pela autorização — exige apenas token válido
-    if QR_CHECK_AUTH_ON_CHECKOUT:
-        # Exigir autorização vigente
-        df_auth_now = list_authorized_people_now(qkey)
-        if df_auth_now.empty or not (df_auth_now["id"] == pid).any():
-            st.error("Você não está autorizado(a) a retirar esta chave neste período.")
-            return
-        prow = df_auth_now[df_auth_now["id"] == pid].iloc[0]
-    else:
-        # Não exigir autorização: token emitido pelo gestor já vale como autorização
-        person = get_person(pid)
-        if person is None or (("is_active" in person.index) and (int(person["is_active"]) != 1)):
-            st.error("Pessoa não encontrada ou inativa.")
-            return
-        prow = person
+    # Busca pessoa (política de autorização em QR_CHECK_AUTH_ON_CHECKOUT, ver db.py)
+    prow, msg = qr_checkout_person(qkey, pid)
+    if prow is None:
+        st.error(msg); return
 
     # Info do espaço
     df_spaces_all = list_spaces(active_only=False)
@@ -690,20 +437,63 @@ def render_public_qr_checkout(qkey: int, pid: str, token: Optional[str]):
         background_color="#FFFFFF", height=180, width=500, drawing_mode="freedraw", key="sig_out_public"
     )
     if st.button("Confirmar retirada", key="btn_checkout_public"):
-        sig_bytes = None
-        if canvas_out.image_data is not None:
-            try:
-                img = Image.fromarray((canvas_out.image_data).astype("uint8"))
-                buf = io.BytesIO(); img.save(buf, format="PNG"); sig_bytes = buf.getvalue()
-            except Exception:
-                sig_bytes = None
-        ok, msg = open_checkout(int(qkey), prow["name"], prow["id_code"], prow["phone"], due_time, sig_bytes)
+        sig_bytes = canvas_png(canvas_out)
+        ok, msg = qr_checkout(int(qkey), pid, token, due_time, sig_bytes)  # revalida e consome o token
         if ok:
-            consume_qr_token(token)  # consome token após sucesso
             st.success(f"Retirada registrada. Protocolo: {msg}")
         else:
             st.error(msg)
 
+# -------------- LOTE VIA QR (PÚBLICO) --------
+def render_batch_keys_info(keys: List[int]):
+    df_spaces_all = list_spaces(active_only=False)
+    df_keys = df_spaces_all[df_spaces_all["key_number"].isin(keys)]
+    st.dataframe(df_keys[["key_number","room_name","location","category"]], use_container_width=True, hide_index=True)
+
+def render_public_qr_batch_return(keys: List[int], token: Optional[str]):
+    st.subheader("Devolução de chaves em lote (via QR)")
+    if token:
+        ok, msg = validate_qr_token(token, "devolver", keys, None)
+        if not ok:
+            st.error(msg); return
+    render_batch_keys_info(keys)
+    st.caption("Assine para confirmar a devolução de todas as chaves")
+    canvas_in = st_canvas(
+        fill_color="rgba(0, 0, 0, 0)", stroke_width=2, stroke_color="#000000",
+        background_color="#FFFFFF", height=180, width=500, drawing_mode="freedraw", key="sig_batch_in_public"
+    )
+    if st.button("Confirmar devolução", key="btn_batch_checkin_public"):
+        ok, results = qr_batch_checkin(keys, token, canvas_png(canvas_in))  # revalida e consome o token (se houver)
+        if ok: st.success(f"{len(results)} chave(s) devolvida(s).")
+        else:  st.error("Devolução recusada; nenhuma chave foi registrada.")
+        st.dataframe(pd.DataFrame(results), use_container_width=True, hide_index=True)
+
+def render_public_qr_batch_checkout(keys: List[int], pid: str, token: Optional[str]):
+    """Retirada em lote: o token foi emitido para esta pessoa e exatamente estas chaves."""
+    st.subheader("Retirada de chaves em lote (via QR)")
+    if not token:
+        st.error("Token ausente. Solicite um novo QR ao gestor."); return
+    ok, msg = validate_qr_token(token, "retirar", keys, pid)
+    if not ok:
+        st.error(msg); return
+    prow, msg = qr_checkout_person(keys[0], pid)
+    if prow is None:
+        st.error(msg); return
+    render_batch_keys_info(keys)
+    st.markdown(f"**Responsável:** {prow['name']}" + (f" ({prow['id_code']})" if prow["id_code"] else ""))
+    due_opt = st.selectbox("Prazo", ["Hoje 18:00", "Sem prazo"], index=0, key="batch_due_public")
+    due_time = datetime.datetime.combine(datetime.date.today(), datetime.time(18,0)) if due_opt == "Hoje 18:00" else None
+    st.caption("Assinatura – Confirmação de retirada")
+    canvas_out = st_canvas(
+        fill_color="rgba(0, 0, 0, 0)", stroke_width=2, stroke_color="#000000",
+        background_color="#FFFFFF", height=180, width=500, drawing_mode="freedraw", key="sig_batch_out_public"
+    )
+    if st.button("Confirmar retirada", key="btn_batch_checkout_public"):
+        ok, results = qr_batch_checkout(keys, pid, token, due_time, canvas_png(canvas_out))  # revalida e consome o token
+        if ok: st.success(f"Retirada registrada: {len(results)} chave(s).")
+        else:  st.error("Retirada recusada; nenhuma chave foi registrada.")
+        st.dataframe(pd.DataFrame(results), use_container_width=True, hide_index=True)
+
 # -------------- CADASTROS (ADMIN) -----------
 if is_admin:
     with tab_cad:
@@ -773,7 +563,7 @@ if is_admin:
             est = st.selectbox("Status", ["Ativo","Inativo"],
                                index=0 if prow["is_active"]==1 else 1, key="edit_status")
             if st.button("Atualizar responsável", key="edit_person_btn"):
-                update_person(sel_pid, en.strip(), eidc.strip(), eph.strip(), 1 if est=="Ativo" else 0)
+                update_person(int(sel_pid), en.strip(), eidc.strip(), eph.strip(), 1 if est=="Ativo" else 0)
                 st.success("Responsável atualizado.")
 
         st.markdown("___")
@@ -803,20 +593,29 @@ if is_admin:
                     if st.button("Adicionar à autorização", key="auth_people_add"):
                         for nm in sel_people:
                             pid = dfp[dfp["name"]==nm].iloc[0]["id"]
-                            add_person_to_authorization(sel_auth, pid)
+                            add_person_to_authorization(int(sel_auth), int(pid))
                         st.success("Pessoas adicionadas.")
                 c = conn()
                 df_link = pd.read_sql_query("""
                     SELECT p.name, p.id_code, p.phone FROM persons p
                     JOIN authorization_people ap ON ap.person_id = p.id
                     WHERE ap.authorization_id=?
-                """, c, params=[sel_auth])
+                """, c, params=[int(sel_auth)])
                 st.write("Vinculados:")
                 st.dataframe(df_link, use_container_width=True)
 
 # -------------- RELATÓRIOS (ADMIN) ----------
 if is_admin:
     with tab_rep:
+        st.subheader("Buscar movimentações")
+        rep_q = st.text_input("Nome, SIAPE/matrícula, telefone, sala, localização ou nº da chave",
+                              key="rep_search", help="Sem diferenciar acentos; busca todo o histórico.")
+        if rep_q.strip():
+            df_found = search_transactions(rep_q)
+            st.caption(f"{len(df_found)} resultado(s), do mais relevante ao menos relevante (máx. 200).")
+            st.dataframe(df_found, use_container_width=True)
+
+        st.markdown("---")
         st.subheader("Movimentações")
         colr1, colr2 = st.columns(2)
         with colr1: dt_start = st.date_input("Início (opcional)", key="rep_start")
@@ -854,6 +653,90 @@ if is_admin:
         csv = df_tx.to_csv(index=False).encode("utf-8")
         st.download_button("Baixar CSV", data=csv, file_name="movimentacoes.csv", key="rep_csv_btn")
 
+        st.markdown("---")
+        st.subheader("Uso agregado")
+        colu1, colu2 = st.columns(2)
+        with colu1: us_start = st.date_input("Início", value=datetime.date.today() - datetime.timedelta(days=365), key="use_start")
+        with colu2: us_end   = st.date_input("Fim", value=datetime.date.today(), key="use_end")
+        df_by_key = usage_rollup("key_number", us_start, us_end)
+        if df_by_key.empty:
+            st.info("Sem devoluções no período.")
+        else:
+            g1, g2 = st.columns(2)
+            with g1:
+                st.caption("Salas mais usadas (retiradas)")
+                st.bar_chart(df_by_key.assign(sala=df_by_key["key_number"].astype(str) + " - " + df_by_key["room_name"])
+                             .set_index("sala")["uses"].sort_values(ascending=False).head(20))
+            with g2:
+                st.caption("Horas com a chave por pessoa")
+                df_by_person = usage_rollup("person", us_start, us_end)
+                st.bar_chart(df_by_person.set_index("person")["hours"].sort_values(ascending=False).head(20))
+            g3, g4 = st.columns(2)
+            with g3:
+                st.caption("Taxa de atraso por categoria")
+                st.bar_chart(usage_rollup("category", us_start, us_end).set_index("category")["overdue_rate"])
+            with g4:
+                st.caption("Retiradas por hora do dia")
+                st.bar_chart(usage_rollup("hour", us_start, us_end).set_index("hour")["uses"])
+            st.caption("Retiradas por dia")
+            st.line_chart(usage_rollup("day", us_start, us_end).set_index("day")["uses"])
+
+        sites = list_sites()
+        if len(sites) > 1:
+            st.markdown("---")
+            st.subheader("Consolidado (todas as guaritas)")
+            st.caption(" • ".join(name for name, _ in sites) + f"  (esta: {SITE_NAME})")
+            df_all_status, errs = list_status_all_sites()
+            for site, err in errs.items():
+                st.warning(f"Guarita {site} indisponível: {err}")
+            st.dataframe(df_all_status, use_container_width=True)
+            df_all_tx, errs_tx = list_transactions_all_sites(start_dt, end_dt)
+            st.dataframe(df_all_tx, use_container_width=True)
+            st.download_button("Baixar CSV consolidado", data=df_all_tx.to_csv(index=False).encode("utf-8"),
+                               file_name="movimentacoes_consolidado.csv", key="rep_csv_all_btn")
+
+        st.markdown("---")
+        st.subheader("Histórico de atrasos")
+        df_ov_hist = list_overdue(current_only=False)
+        st.dataframe(df_ov_hist.drop(columns=["transaction_id"]), use_container_width=True)
+
+        st.markdown("---")
+        st.subheader("Backups")
+        bst = backup_status()
+        if bst["last_error"]:
+            st.error(f"Último backup falhou ({bst['last_at']}): {bst['last_error']}")
+        if st.button("Fazer backup agora", key="backup_now_btn"):
+            try:
+                path = backup_now()
+                st.success(f"Snapshot verificado e salvo: {os.path.basename(path)} ({backup_status()['last_seconds']} s)")
+            except Exception as e:
+                st.error(f"Falha no backup: {e}")
+        backups = list_backups()
+        if not backups:
+            st.info("Nenhum snapshot ainda.")
+        else:
+            st.caption(f"{len(backups)} snapshot(s) em rotação • mais recente: {os.path.basename(backups[0])} "
+                       f"({os.path.getsize(backups[0]) / 1024:.0f} KB)")
+            # o arquivo só é lido quando o admin pede, não a cada rerun da aba
+            if st.button("Preparar download do último snapshot", key="backup_prep_btn"):
+                st.session_state["backup_dl_path"] = backups[0]
+            dl_path = st.session_state.get("backup_dl_path")
+            if dl_path and os.path.exists(dl_path):
+                with open(dl_path, "rb") as f_latest:
+                    st.download_button(f"Baixar {os.path.basename(dl_path)}", data=f_latest.read(),
+                                       file_name=os.path.basename(dl_path), mime="application/gzip",
+                                       key="backup_dl_btn",
+                                       on_click=lambda: st.session_state.pop("backup_dl_path", None))
+
+        with st.expander("Armazenamento (tabelas e índices)"):
+            df_store = storage_report()
+            st.caption(f"Total: {df_store['bytes'].sum() / 1024:.0f} KB")
+            st.dataframe(df_store, use_container_width=True)
+            df_mig = migration_report()
+            if not df_mig.empty:
+                st.caption("Migração para ids inteiros: bytes por tabela/índice antes e depois")
+                st.dataframe(df_mig, use_container_width=True)
+
 # -------------- QR CODES (ADMIN) ------------
 if is_admin:
     with tab_qr:
@@ -876,10 +759,10 @@ if is_admin:
                         with cset[c]:
                             if use_token_return:
                                 token, exp = create_qr_token("devolver", int(keyn), None, TOKEN_TTL_MINUTES)
-                                url = build_url(base_url, {"key": keyn, "action": "devolver", "token": token})
+                                url = build_url(scan_url, {"key": keyn, "action": "devolver", "token": token})
                                 exp_txt = f" (expira {exp.strftime('%d/%m %H:%M')})"
                             else:
-                                url = build_url(base_url, {"key": keyn, "action": "devolver"})
+                                url = build_url(scan_url, {"key": keyn, "action": "devolver"})
                                 exp_txt = ""
                             img = make_qr(url)
                             st.image(img, use_container_width=True)
@@ -903,10 +786,10 @@ if is_admin:
         else:
             sel_key_checkout = st.selectbox("Chave (retirada)", options=df_sp_act["key_number"].tolist(), key="qr_checkout_key_admin")
             sel_person_checkout = st.selectbox("Responsável (retirada)", options=dfp_all["name"].tolist(), key="qr_checkout_person_admin2")
-            pid_val2 = dfp_all[dfp_all["name"] == sel_person_checkout].iloc[0]["id"]
+            pid_val2 = dfp_all[dfp_all["name"] == sel_person_checkout].iloc[0]["uid"]
             if st.button("Gerar QR de Retirada (token único)", key="qr_checkout_make_admin"):
                 token, exp = create_qr_token("retirar", int(sel_key_checkout), pid_val2, TOKEN_TTL_MINUTES)
-                url_checkout = build_url(base_url, {"key": int(sel_key_checkout), "action": "retirar", "pid": pid_val2, "token": token})
+                url_checkout = build_url(scan_url, {"key": int(sel_key_checkout), "action": "retirar", "pid": pid_val2, "token": token})
                 img_checkout = make_qr(url_checkout)
                 st.image(img_checkout, use_container_width=False)
                 st.caption(url_checkout)
@@ -915,15 +798,49 @@ if is_admin:
                                    file_name=f"qr_retirar_key{int(sel_key_checkout)}_{pid_val2[:8]}.png",
                                    key="qr_checkout_dl_admin")
 
+        st.markdown("---")
+        st.subheader("QR de lote (várias chaves, um token)")
+        if df_sp_act.empty:
+            st.info("Nenhuma chave ativa cadastrada.")
+        else:
+            batch_action = st.radio("Ação", ["retirar", "devolver"], horizontal=True, key="qr_batch_action")
+            batch_qr_keys = st.multiselect("Chaves do lote", options=df_sp_act["key_number"].tolist(),
+                                           max_selections=BATCH_MAX_KEYS, key="qr_batch_keys")
+            pid_batch = None
+            if batch_action == "retirar":
+                if dfp_all.empty:
+                    st.info("Cadastre pessoas para gerar QR de retirada.")
+                else:
+                    sel_person_batch = st.selectbox("Responsável", options=dfp_all["name"].tolist(), key="qr_batch_person")
+                    pid_batch = dfp_all[dfp_all["name"] == sel_person_batch].iloc[0]["uid"]
+            if st.button("Gerar QR de lote (token único)", key="qr_batch_make",
+                         disabled=not batch_qr_keys or (batch_action == "retirar" and pid_batch is None)):
+                keys_txt = ",".join(str(int(k)) for k in sorted(batch_qr_keys))
+                token, exp = create_qr_token(batch_action, [int(k) for k in batch_qr_keys], pid_batch, TOKEN_TTL_MINUTES)
+                url_batch = build_url(scan_url, {"keys": keys_txt, "action": batch_action, "pid": pid_batch, "token": token})
+                img_batch = make_qr(url_batch)
+                st.image(img_batch, use_container_width=False)
+                st.caption(url_batch)
+                st.caption(f"Chaves {keys_txt} • expira: {exp.strftime('%d/%m/%Y %H:%M')} (validade {TOKEN_TTL_MINUTES} min)")
+                st.download_button("Baixar QR (PNG)", data=to_png_bytes(img_batch),
+                                   file_name=f"qr_{batch_action}_lote_{keys_txt.replace(',', '-')}.png",
+                                   key="qr_batch_dl")
+
 # -------------- PÚBLICO: RETIRADA VIA QR ----
 if (not is_admin) and public_qr_checkout:
     with tab_pub_checkout:
-        render_public_qr_checkout(int(qp_key), qp_pid, qp_token)
+        if qp_keys:
+            render_public_qr_batch_checkout(qp_keys, qp_pid, qp_token)
+        else:
+            render_public_qr_checkout(int(qp_key), qp_pid, qp_token)
 
 # -------------- PÚBLICO: DEVOLUÇÃO VIA QR ---
 if (not is_admin) and public_qr_return:
     with tab_pub_return:
-        render_public_qr_return(int(qp_key), qp_token)
+        if qp_keys:
+            render_public_qr_batch_return(qp_keys, qp_token)
+        else:
+            render_public_qr_return(int(qp_key), qp_token)
 
 # -------------- PÚBLICO: RELATÓRIOS ----------
 if (not is_admin):
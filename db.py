@@ -0,0 +1,1461 @@
+# ==========================================
+# Guarita - Controle de Chaves :: camada de dados (SQLite)
+# (WAL + busy_timeout + escritas serializadas numa thread única)
+# ==========================================
+import os, re, uuid, json, pathlib, sqlite3, datetime, secrets, threading, queue, time, heapq, hmac, hashlib, base64, glob, gzip, shutil
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional, Tuple, List, Callable, Any, Union, Sequence, Dict
+import pandas as pd
+import sqlite3 as _sqlite3  # capturar IntegrityError
+
+# -------------- Configurações --------------
+DB_PATH = os.getenv("DB_PATH", "keys.db")
+CUTOFF_HOUR_FOR_OVERDUE = int(os.getenv("CUTOFF_HOUR_FOR_OVERDUE", "23"))  # atraso até 23:00
+TOKEN_TTL_MINUTES = int(os.getenv("TOKEN_TTL_MINUTES", "30"))  # validade padrão do token
+QR_TOKEN_SECRET = os.getenv("QR_TOKEN_SECRET", "")  # chave HMAC dos tokens; vazio = gerada e guardada no banco
+QR_CHECK_AUTH_ON_CHECKOUT = os.getenv("QR_CHECK_AUTH_ON_CHECKOUT", "false").lower() == "true" # false (não exige autorização no QR de retirada).
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))  # espera por lock antes de "database is locked"
+DB_CACHE_KB = int(os.getenv("DB_CACHE_KB", "16384"))  # cache de páginas por conexão
+SITE_NAME = os.getenv("SITE_NAME", "Local")  # nome desta guarita nos relatórios consolidados
+SITE_DBS = os.getenv("SITE_DBS", "")  # outras guaritas: "Nome=/caminho/a.db;Nome 2=/caminho/b.db" (só leitura)
+OVERDUE_REFRESH_S = int(os.getenv("OVERDUE_REFRESH_S", "300"))  # releitura das retiradas em aberto pelo monitor
+CHANGE_LOG_KEEP = int(os.getenv("CHANGE_LOG_KEEP", "50000"))  # linhas mantidas no change_log
+CHANGE_LOG_PRUNE_EVERY = int(os.getenv("CHANGE_LOG_PRUNE_EVERY", "1000"))  # escritas entre podas pela thread de escrita (0 = não poda)
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_INTERVAL_MIN = int(os.getenv("BACKUP_INTERVAL_MIN", "0"))  # 0 = sem agendamento (só manual)
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "14"))  # snapshots mantidos na rotação
+BATCH_MAX_KEYS = int(os.getenv("BATCH_MAX_KEYS", "20"))  # chaves por retirada/devolução em lote (e por QR de lote)
+
+# -------------- Utilidades -----------------
+def now_iso():
+    return datetime.datetime.now().isoformat(timespec="seconds")
+
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+def _unb64(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+# -------------- Conexões -------------------
+def _apply_pragmas(c: sqlite3.Connection):
+    c.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS};")
+    c.execute("PRAGMA foreign_keys = ON;")
+    c.execute("PRAGMA synchronous = NORMAL;")   # seguro em WAL; fsync só no checkpoint
+    c.execute(f"PRAGMA cache_size = -{DB_CACHE_KB};")
+    c.execute("PRAGMA temp_store = MEMORY;")
+
+def _connect(path: str) -> sqlite3.Connection:
+    c = sqlite3.connect(path, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+    _apply_pragmas(c)
+    return c
+
+_schema_lock = threading.Lock()
+_schema_ready = set()  # caminhos já inicializados neste processo
+
+def _create_core_tables(c: sqlite3.Connection):
+    """Tabelas com chave INTEGER (rowid); o UUID fica só em uid, como identificador público
+    (pid nas URLs de QR, protocolo da movimentação). Também usado pela migração."""
+    # persons
+    c.execute("""
+      CREATE TABLE IF NOT EXISTS persons(
+        id INTEGER PRIMARY KEY,
+        uid TEXT NOT NULL UNIQUE,     -- público: pid nos QRs de retirada
+        name TEXT NOT NULL,
+        id_code TEXT,
+        phone TEXT,
+        is_active INTEGER DEFAULT 1
+      )
+    """)
+
+    # transactions
+    c.execute("""
+      CREATE TABLE IF NOT EXISTS transactions(
+        id INTEGER PRIMARY KEY,
+        uid TEXT NOT NULL UNIQUE,     -- público: protocolo
+        key_number INTEGER NOT NULL,
+        taken_by_name TEXT NOT NULL,
+        taken_by_id   TEXT,
+        taken_phone   TEXT,
+        checkout_time TEXT NOT NULL,
+        due_time      TEXT,
+        checkin_time  TEXT,
+        status        TEXT,             -- EM_USO / DEVOLVIDA
+        signature_out BLOB,
+        signature_in  BLOB,
+        FOREIGN KEY (key_number) REFERENCES spaces(key_number)
+      )
+    """)
+
+    # authorizations
+    c.execute("""
+      CREATE TABLE IF NOT EXISTS authorizations(
+        id INTEGER PRIMARY KEY,
+        key_number INTEGER NOT NULL,
+        memo_number TEXT,
+        valid_from TEXT,
+        valid_to   TEXT,
+        created_at TEXT,
+        FOREIGN KEY (key_number) REFERENCES spaces(key_number)
+      )
+    """)
+    c.execute("""
+      CREATE TABLE IF NOT EXISTS authorization_people(
+        id INTEGER PRIMARY KEY,
+        authorization_id INTEGER NOT NULL,
+        person_id INTEGER NOT NULL,
+        FOREIGN KEY (authorization_id) REFERENCES authorizations(id),
+        FOREIGN KEY (person_id) REFERENCES persons(id)
+      )
+    """)
+
+    # qr_tokens (legado: tokens aleatórios gravados um a um; só validados até expirarem)
+    c.execute("""
+      CREATE TABLE IF NOT EXISTS qr_tokens(
+        token TEXT PRIMARY KEY,
+        action TEXT NOT NULL,         -- 'retirar' | 'devolver'
+        key_number INTEGER NOT NULL,
+        person_id INTEGER,            -- opcional (obrigatório para retirar personalizada)
+        expires_at TEXT NOT NULL,
+        used_at TEXT,
+        created_at TEXT NOT NULL,
+        FOREIGN KEY (key_number) REFERENCES spaces(key_number),
+        FOREIGN KEY (person_id) REFERENCES persons(id)
+      )
+    """)
+
+    # overdue_events (snapshot/histórico do monitor de atrasos; resolved_at NULL = ainda atrasada)
+    c.execute("""
+      CREATE TABLE IF NOT EXISTS overdue_events(
+        transaction_id INTEGER PRIMARY KEY,
+        key_number     INTEGER NOT NULL,
+        taken_by_name  TEXT,
+        overdue_since  TEXT NOT NULL,   -- prazo efetivo (due_time ou corte das 23h)
+        detected_at    TEXT NOT NULL,
+        resolved_at    TEXT,            -- checkin_time quando devolvida
+        FOREIGN KEY (transaction_id) REFERENCES transactions(id)
+      )
+    """)
+
+def _create_schema(c: sqlite3.Connection):
+    # spaces (+ category)
+    c.execute("""
+      CREATE TABLE IF NOT EXISTS spaces(
+        key_number INTEGER PRIMARY KEY,
+        room_name  TEXT NOT NULL,
+        location   TEXT,
+        is_active  INTEGER DEFAULT 1
+      )
+    """)
+    try:
+        c.execute("ALTER TABLE spaces ADD COLUMN category TEXT DEFAULT 'Sala'")
+    except Exception:
+        pass
+
+    _create_core_tables(c)
+
+    # signatures (assinatura gravada uma vez e referenciada por todas as movimentações de um lote)
+    c.execute("""
+      CREATE TABLE IF NOT EXISTS signatures(
+        id INTEGER PRIMARY KEY,
+        png BLOB NOT NULL,
+        created_at TEXT NOT NULL
+      )
+    """)
+    for col in ("signature_out_id", "signature_in_id"):
+        try:
+            c.execute(f"ALTER TABLE transactions ADD COLUMN {col} INTEGER REFERENCES signatures(id)")
+        except Exception:
+            pass
+
+    # qr_used (tokens assinados já consumidos; a emissão não grava nada)
+    c.execute("""
+      CREATE TABLE IF NOT EXISTS qr_used(
+        sig        TEXT PRIMARY KEY,   -- assinatura HMAC do token
+        key_number INTEGER NOT NULL,
+        expires_at TEXT NOT NULL,      -- depois disso a linha pode ser apagada
+        used_at    TEXT NOT NULL
+      )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_qr_used_exp ON qr_used(expires_at)")
+
+    # app_settings (segredo HMAC dos tokens quando QR_TOKEN_SECRET não é definido)
+    c.execute("CREATE TABLE IF NOT EXISTS app_settings(name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+    c.execute("INSERT OR IGNORE INTO app_settings(name, value) VALUES('qr_token_secret', ?)", (secrets.token_hex(32),))
+
+    c.execute("CREATE INDEX IF NOT EXISTS idx_overdue_open ON overdue_events(resolved_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_auth_key ON authorizations(key_number)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_authp_auth ON authorization_people(authorization_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_authp_person ON authorization_people(person_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_tx_open ON transactions(key_number) WHERE checkin_time IS NULL")
+
+    # usage_daily (agregado incremental: atualizado a cada devolução, por dia/hora da retirada)
+    c.execute("""
+      CREATE TABLE IF NOT EXISTS usage_daily(
+        day          TEXT NOT NULL,     -- data da retirada (YYYY-MM-DD)
+        hour         INTEGER NOT NULL,  -- hora da retirada (0-23)
+        key_number   INTEGER NOT NULL,
+        category     TEXT,
+        person       TEXT NOT NULL,     -- taken_by_name
+        uses         INTEGER NOT NULL DEFAULT 0,
+        held_seconds INTEGER NOT NULL DEFAULT 0,
+        overdue      INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, hour, key_number, person)
+      )
+    """)
+    if c.execute("SELECT 1 FROM usage_daily LIMIT 1").fetchone() is None:
+        # primeira vez (ou tabela nova): agrega o histórico já devolvido
+        for (tid,) in c.execute("SELECT id FROM transactions WHERE checkin_time IS NOT NULL").fetchall():
+            _rollup_closed(c, tid)
+
+    try:
+        _create_search_index(c)
+    except sqlite3.OperationalError:
+        pass  # SQLite sem FTS5: search_transactions cai no LIKE
+
+    _create_change_log(c)
+
+def _create_change_log(c: sqlite3.Connection):
+    # change_log: sequência monotônica de alterações (cursor para o painel ao vivo / changes_since)
+    c.execute("""
+      CREATE TABLE IF NOT EXISTS change_log(
+        seq        INTEGER PRIMARY KEY AUTOINCREMENT,
+        at         TEXT NOT NULL,
+        entity     TEXT NOT NULL,      -- transaction | qr_token | space | person | authorization | overdue
+        op         TEXT NOT NULL,      -- insert | update
+        key_number INTEGER,            -- chave afetada (NULL para cadastros de pessoas)
+        ref        TEXT                -- uid (pessoa/movimentação) ou id da linha alterada
+      )
+    """)
+    # (tabela, entidade, expressão da chave, expressão do id) — triggers valem para qualquer processo
+    sources = [
+        ("transactions",         "transaction",   "new.key_number", "new.uid"),
+        ("qr_tokens",            "qr_token",      "new.key_number", "NULL"),  # token é segredo
+        ("qr_used",              "qr_token",      "new.key_number", "NULL"),
+        ("spaces",               "space",         "new.key_number", "new.key_number"),
+        ("persons",              "person",        "NULL",           "new.uid"),
+        ("authorizations",       "authorization", "new.key_number", "new.id"),
+        ("authorization_people", "authorization",
+         "(SELECT key_number FROM authorizations WHERE id = new.authorization_id)", "new.authorization_id"),
+        ("overdue_events",       "overdue",       "new.key_number", "new.transaction_id"),
+    ]
+    for table, entity, key_expr, ref_expr in sources:
+        for op in ("insert", "update"):
+            c.execute(f"""
+              CREATE TRIGGER IF NOT EXISTS {table}_changelog_{op} AFTER {op.upper()} ON {table} BEGIN
+                INSERT INTO change_log(at, entity, op, key_number, ref)
+                VALUES(strftime('%Y-%m-%dT%H:%M:%S', 'now', 'localtime'), '{entity}', '{op}', {key_expr}, {ref_expr});
+              END
+            """)
+
+def _create_search_index(c: sqlite3.Connection):
+    # transactions_fts: busca textual por movimentações (rowid = transactions.rowid), sem acento
+    is_new = c.execute("SELECT 1 FROM sqlite_master WHERE name='transactions_fts'").fetchone() is None
+    c.execute("""
+      CREATE VIRTUAL TABLE IF NOT EXISTS transactions_fts USING fts5(
+        taken_by_name, taken_by_id, taken_phone, room_name, location, key_text,
+        tokenize = 'unicode61 remove_diacritics 2'
+      )
+    """)
+    c.execute("""
+      CREATE TRIGGER IF NOT EXISTS transactions_fts_ai AFTER INSERT ON transactions BEGIN
+        INSERT INTO transactions_fts(rowid, taken_by_name, taken_by_id, taken_phone, room_name, location, key_text)
+        SELECT new.rowid, new.taken_by_name, new.taken_by_id, new.taken_phone, s.room_name, s.location, CAST(new.key_number AS TEXT)
+        FROM (SELECT 1) LEFT JOIN spaces s ON s.key_number = new.key_number;
+      END
+    """)
+    c.execute("""
+      CREATE TRIGGER IF NOT EXISTS transactions_fts_au
+      AFTER UPDATE OF taken_by_name, taken_by_id, taken_phone, key_number ON transactions BEGIN
+        DELETE FROM transactions_fts WHERE rowid = old.rowid;
+        INSERT INTO transactions_fts(rowid, taken_by_name, taken_by_id, taken_phone, room_name, location, key_text)
+        SELECT new.rowid, new.taken_by_name, new.taken_by_id, new.taken_phone, s.room_name, s.location, CAST(new.key_number AS TEXT)
+        FROM (SELECT 1) LEFT JOIN spaces s ON s.key_number = new.key_number;
+      END
+    """)
+    c.execute("""
+      CREATE TRIGGER IF NOT EXISTS transactions_fts_ad AFTER DELETE ON transactions BEGIN
+        DELETE FROM transactions_fts WHERE rowid = old.rowid;
+      END
+    """)
+    c.execute("""
+      CREATE TRIGGER IF NOT EXISTS spaces_fts_au AFTER UPDATE OF room_name, location ON spaces BEGIN
+        UPDATE transactions_fts SET room_name = new.room_name, location = new.location
+        WHERE rowid IN (SELECT rowid FROM transactions WHERE key_number = new.key_number);
+      END
+    """)
+    if is_new:
+        c.execute("""
+          INSERT INTO transactions_fts(rowid, taken_by_name, taken_by_id, taken_phone, room_name, location, key_text)
+          SELECT t.rowid, t.taken_by_name, t.taken_by_id, t.taken_phone, s.room_name, s.location, CAST(t.key_number AS TEXT)
+          FROM transactions t LEFT JOIN spaces s ON s.key_number = t.key_number
+        """)
+
+def _rollup_closed(c: sqlite3.Connection, tid: int):
+    """Soma uma retirada devolvida em usage_daily (roda dentro da transação da devolução)."""
+    row = c.execute("""SELECT t.key_number, s.category, t.taken_by_name, t.checkout_time, t.due_time, t.checkin_time
+                       FROM transactions t LEFT JOIN spaces s ON s.key_number = t.key_number
+                       WHERE t.id=? AND t.checkin_time IS NOT NULL""", (tid,)).fetchone()
+    if not row:
+        return
+    keyn, cat, person, co, due, ci = row
+    try:
+        co_dt = datetime.datetime.fromisoformat(co); ci_dt = datetime.datetime.fromisoformat(ci)
+    except Exception:
+        return
+    deadline = overdue_deadline(co, due)
+    c.execute("""INSERT INTO usage_daily(day, hour, key_number, category, person, uses, held_seconds, overdue)
+                 VALUES(?,?,?,?,?,1,?,?)
+                 ON CONFLICT(day, hour, key_number, person) DO UPDATE SET
+                   uses = uses + 1,
+                   held_seconds = held_seconds + excluded.held_seconds,
+                   overdue = overdue + excluded.overdue,
+                   category = excluded.category""",
+              (co_dt.date().isoformat(), co_dt.hour, keyn, cat or "Sala", person,
+               max(int((ci_dt - co_dt).total_seconds()), 0),
+               1 if deadline is not None and ci_dt > deadline else 0))
+
+# ----- Migração: ids UUID (TEXT) -> INTEGER -----
+_UUID_KEYED_TABLES = ("persons", "transactions", "authorizations", "authorization_people", "qr_tokens", "overdue_events")
+
+def _needs_int_ids(c: sqlite3.Connection) -> bool:
+    cols = [r[1] for r in c.execute("PRAGMA table_info(persons)")]
+    return bool(cols) and "uid" not in cols
+
+def _migrate_int_ids(c: sqlite3.Connection):
+    """Reescreve as tabelas de chave UUID com chave INTEGER, preservando os dados:
+    o UUID antigo de persons/transactions vira uid (pid dos QRs e protocolos continuam
+    válidos) e as referências (authorization_people, qr_tokens, overdue_events) são
+    traduzidas para os novos ids. Roda numa transação só, com foreign_keys desligado."""
+    before = storage_report(c).set_index("name")["bytes"].to_dict()
+    c.execute("PRAGMA foreign_keys = OFF")
+    c.isolation_level = None
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        if not _needs_int_ids(c):
+            # outro processo (app + scan_api) migrou enquanto esperávamos o lock
+            c.execute("COMMIT")
+            return
+        # triggers/índices/FTS são recriados por _create_schema
+        for (name,) in c.execute("SELECT name FROM sqlite_master WHERE type='trigger'").fetchall():
+            c.execute(f'DROP TRIGGER "{name}"')
+        c.execute("DROP TABLE IF EXISTS transactions_fts")
+        existing = {r[0] for r in c.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+        old = [t for t in _UUID_KEYED_TABLES if t in existing]
+        for (name,) in c.execute(f"""SELECT name FROM sqlite_master WHERE type='index' AND sql IS NOT NULL
+                                     AND tbl_name IN ({",".join("?" * len(old))})""", old).fetchall():
+            c.execute(f'DROP INDEX "{name}"')
+        for t in old:
+            c.execute(f"ALTER TABLE {t} RENAME TO {t}_v1")
+        _create_core_tables(c)
+
+        c.execute("""INSERT INTO persons(uid, name, id_code, phone, is_active)
+                     SELECT id, name, id_code, phone, is_active FROM persons_v1 ORDER BY rowid""")
+        if "transactions" in old:
+            c.execute("""INSERT INTO transactions(uid, key_number, taken_by_name, taken_by_id, taken_phone,
+                                                  checkout_time, due_time, checkin_time, status, signature_out, signature_in)
+                         SELECT id, key_number, taken_by_name, taken_by_id, taken_phone,
+                                checkout_time, due_time, checkin_time, status, signature_out, signature_in
+                         FROM transactions_v1 ORDER BY checkout_time, rowid""")
+        if "authorizations" in old:
+            c.execute("CREATE TEMP TABLE auth_map(new_id INTEGER PRIMARY KEY, old_id TEXT UNIQUE)")
+            c.execute("INSERT INTO temp.auth_map(old_id) SELECT id FROM authorizations_v1 ORDER BY rowid")
+            c.execute("""INSERT INTO authorizations(id, key_number, memo_number, valid_from, valid_to, created_at)
+                         SELECT m.new_id, a.key_number, a.memo_number, a.valid_from, a.valid_to, a.created_at
+                         FROM authorizations_v1 a JOIN temp.auth_map m ON m.old_id = a.id""")
+            if "authorization_people" in old:
+                c.execute("""INSERT INTO authorization_people(authorization_id, person_id)
+                             SELECT m.new_id, p.id FROM authorization_people_v1 ap
+                             JOIN temp.auth_map m ON m.old_id = ap.authorization_id
+                             JOIN persons p ON p.uid = ap.person_id
+                             ORDER BY ap.rowid""")
+            c.execute("DROP TABLE temp.auth_map")
+        if "qr_tokens" in old:
+            c.execute("""INSERT INTO qr_tokens(token, action, key_number, person_id, expires_at, used_at, created_at)
+                         SELECT q.token, q.action, q.key_number, p.id, q.expires_at, q.used_at, q.created_at
+                         FROM qr_tokens_v1 q LEFT JOIN persons p ON p.uid = q.person_id""")
+        if "overdue_events" in old:
+            c.execute("""INSERT INTO overdue_events(transaction_id, key_number, taken_by_name, overdue_since, detected_at, resolved_at)
+                         SELECT t.id, o.key_number, o.taken_by_name, o.overdue_since, o.detected_at, o.resolved_at
+                         FROM overdue_events_v1 o JOIN transactions t ON t.uid = o.transaction_id""")
+        for t in old:
+            c.execute(f"DROP TABLE {t}_v1")
+        problems = c.execute("PRAGMA foreign_key_check").fetchall()
+        if problems:
+            raise RuntimeError(f"Migração para ids inteiros violaria chaves estrangeiras: {problems[:5]}")
+        c.execute("COMMIT")
+    except BaseException:
+        c.execute("ROLLBACK")
+        raise
+    finally:
+        c.isolation_level = ""
+        c.execute("PRAGMA foreign_keys = ON")
+    c.execute("VACUUM")  # devolve ao SO as páginas das tabelas antigas
+    _create_schema(c)    # índices, FTS, triggers (antes de medir o "depois")
+    c.commit()
+    after = storage_report(c).set_index("name")["bytes"].to_dict()
+    c.execute("CREATE TABLE IF NOT EXISTS app_settings(name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+    c.execute("INSERT OR REPLACE INTO app_settings(name, value) VALUES('migration_int_ids', ?)",
+              (json.dumps({"at": now_iso(), "before": before, "after": after}),))
+    c.commit()
+
+def storage_report(c: Optional[sqlite3.Connection] = None) -> pd.DataFrame:
+    """Bytes ocupados por tabela e índice (tabela virtual dbstat); sem dbstat, só o arquivo inteiro."""
+    c = c or conn()
+    try:
+        return pd.read_sql_query("""
+            SELECT d.name, COALESCE(m.type, 'table') AS type, COALESCE(m.tbl_name, d.name) AS table_name,
+                   SUM(d.pgsize) AS bytes, SUM(d.ncell) AS cells
+            FROM dbstat d LEFT JOIN sqlite_master m ON m.name = d.name
+            GROUP BY d.name ORDER BY bytes DESC""", c)
+    except Exception:
+        pages = c.execute("PRAGMA page_count").fetchone()[0] - c.execute("PRAGMA freelist_count").fetchone()[0]
+        size = pages * c.execute("PRAGMA page_size").fetchone()[0]
+        return pd.DataFrame([{"name": "(arquivo)", "type": "file", "table_name": "", "bytes": size, "cells": None}])
+
+def migration_report() -> pd.DataFrame:
+    """Tamanho por tabela/índice antes e depois da migração para ids inteiros (se houve)."""
+    c = conn()
+    row = c.execute("SELECT value FROM app_settings WHERE name='migration_int_ids'").fetchone()
+    if not row:
+        return pd.DataFrame(columns=["name", "before", "after"])
+    data = json.loads(row[0])
+    names = sorted(set(data["before"]) | set(data["after"]))
+    return pd.DataFrame([{"name": n, "before": data["before"].get(n), "after": data["after"].get(n)} for n in names])
+
+def init_db(path: Optional[str] = None):
+    """Cria o schema e liga o WAL uma única vez por processo (não a cada conexão)."""
+    path = path or DB_PATH
+    if path in _schema_ready:
+        return
+    with _schema_lock:
+        if path in _schema_ready:
+            return
+        c = _connect(path)
+        try:
+            c.execute("PRAGMA journal_mode = WAL;")  # persistente no arquivo
+            if _needs_int_ids(c):
+                _migrate_int_ids(c)
+            with c:
+                _create_schema(c)
+        finally:
+            c.close()
+        _schema_ready.add(path)
+
+_read_conns = threading.local()  # uma conexão de leitura por thread e banco
+
+def conn():
+    """Conexão de leitura. Em WAL, leitores não esperam pela thread de escrita.
+    Reaproveitada pela mesma thread (o cache de páginas e os PRAGMAs valem entre leituras);
+    não feche: ela é de todos os chamadores da thread."""
+    init_db()
+    conns = _read_conns.__dict__.setdefault("by_path", {})
+    c = conns.get(DB_PATH)
+    if c is None:
+        c = conns[DB_PATH] = _connect(DB_PATH)
+    return c
+
+def conn_ro(path: str) -> sqlite3.Connection:
+    """Conexão somente leitura a um banco (de outra guarita): não cria schema nem escreve."""
+    # as_uri() escapa ?, #, % e espaços do caminho (senão abre outro arquivo ou falha)
+    c = sqlite3.connect(pathlib.Path(path).resolve().as_uri() + "?mode=ro", uri=True, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+    c.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS};")
+    c.execute("PRAGMA query_only = ON;")
+    return c
+
+# -------------- Escritor único -------------
+class _Writer:
+    """Thread única dona da conexão de escrita; os jobs chegam por uma fila e
+    cada um roda dentro de uma transação própria (BEGIN IMMEDIATE ... COMMIT)."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.q: "queue.Queue[Tuple[Callable, tuple, Future, float]]" = queue.Queue()
+        self.started = time.monotonic()
+        self.writes = 0
+        self.errors = 0
+        self.busy_s = 0.0
+        self.wait_s = 0.0
+        self.c: Optional[sqlite3.Connection] = None
+        self.failed: Optional[BaseException] = None  # erro ao abrir/criar o banco; a fila não anda
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self.thread.start()
+
+    def _fail(self, e: BaseException):
+        """Sem conexão não há quem atenda a fila: falha o que está nela e o que vier depois."""
+        with self.lock:
+            self.failed = e
+        with _writers_lock:
+            if _writers.get(self.path) is self:
+                del _writers[self.path]  # a próxima escrita cria outro escritor e tenta de novo
+        while True:
+            try:
+                _, _, fut, _ = self.q.get_nowait()
+            except queue.Empty:
+                break
+            if fut.set_running_or_notify_cancel():
+                fut.set_exception(e)
+
+    def _run(self):
+        try:
+            init_db(self.path)
+            c = self.c = _connect(self.path)
+        except BaseException as e:
+            self._fail(e)
+            return
+        c.isolation_level = None  # transações explícitas abaixo
+        while True:
+            fn, args, fut, t_enq = self.q.get()
+            if not fut.set_running_or_notify_cancel():
+                continue
+            t0 = time.perf_counter()
+            self.wait_s += t0 - t_enq
+            try:
+                # IMMEDIATE: pega o lock de escrita já no início, então a checagem e a
+                # escrita do job são atômicas também frente a outros processos
+                c.execute("BEGIN IMMEDIATE")
+                try:
+                    res = fn(c, *args)
+                except BaseException:
+                    c.execute("ROLLBACK")
+                    raise
+                c.execute("COMMIT")
+            except BaseException as e:
+                self.errors += 1
+                fut.set_exception(e)
+            else:
+                fut.set_result(res)
+            finally:
+                self.writes += 1
+                self.busy_s += time.perf_counter() - t0
+            if CHANGE_LOG_PRUNE_EVERY > 0 and self.writes % CHANGE_LOG_PRUNE_EVERY == 0:
+                self._prune(c)
+
+    def _prune(self, c: sqlite3.Connection):
+        """Poda o change_log numa transação própria; toda escrita acrescenta linhas a ele."""
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            try:
+                _prune_change_log(c, CHANGE_LOG_KEEP)
+            except BaseException:
+                c.execute("ROLLBACK")
+                raise
+            c.execute("COMMIT")
+        except Exception:
+            pass  # fica para a próxima poda
+
+    def submit(self, fn: Callable, *args) -> Future:
+        fut: Future = Future()
+        with self.lock:
+            if self.failed is not None:
+                fut.set_exception(self.failed)
+            else:
+                self.q.put((fn, args, fut, time.perf_counter()))
+        return fut
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+def _get_writer(path: Optional[str] = None) -> _Writer:
+    path = path or DB_PATH
+    w = _writers.get(path)
+    if w is None:
+        with _writers_lock:
+            w = _writers.get(path)
+            if w is None:
+                w = _writers[path] = _Writer(path)
+    return w
+
+def run_write(fn: Callable[..., Any], *args, path: Optional[str] = None) -> Any:
+    """Executa fn(c, *args) na thread de escrita e devolve o resultado (ou relança o erro)."""
+    w = _get_writer(path)
+    if threading.current_thread() is w.thread:  # job chamando outro job: já está na transação
+        return fn(w.c, *args)
+    return w.submit(fn, *args).result()
+
+def writer_stats() -> dict:
+    """Vazão da fila de escrita desde o início do processo."""
+    w = _get_writer()
+    uptime = max(time.monotonic() - w.started, 1e-9)
+    done = max(w.writes, 1)
+    return {
+        "writes": w.writes,
+        "errors": w.errors,
+        "queued": w.q.qsize(),
+        "uptime_s": round(uptime, 1),
+        "writes_per_s": round(w.writes / uptime, 3),
+        "avg_write_ms": round(1000 * w.busy_s / done, 2),
+        "avg_wait_ms": round(1000 * w.wait_s / done, 2),
+        "utilization": round(w.busy_s / uptime, 4),
+    }
+
+# ----- Helpers: Spaces -----
+def add_space(key_number: int, room_name: str, location: str = "", category: str = "Sala"):
+    # upsert (não REPLACE): a linha é atualizada, então os triggers de UPDATE (índice de busca, change_log) rodam
+    run_write(lambda c: c.execute("""INSERT INTO spaces(key_number,room_name,location,is_active,category)
+                     VALUES(?,?,?,?,?)
+                     ON CONFLICT(key_number) DO UPDATE SET
+                       room_name=excluded.room_name, location=excluded.location,
+                       is_active=excluded.is_active, category=excluded.category""",
+                  (key_number, room_name, location, 1, category)))
+
+def list_spaces(active_only=True, c: Optional[sqlite3.Connection] = None):
+    c = c or conn()
+    if active_only:
+        return pd.read_sql_query("SELECT * FROM spaces WHERE is_active=1 ORDER BY key_number", c)
+    return pd.read_sql_query("SELECT * FROM spaces ORDER BY key_number", c)
+
+def update_space(key_number: int, room_name: str, location: str, is_active: int, category: str = "Sala"):
+    run_write(lambda c: c.execute("""UPDATE spaces SET room_name=?, location=?, is_active=?, category=? WHERE key_number=?""",
+                                  (room_name, location, int(is_active), category, key_number)))
+
+def get_space(key_number: int) -> Optional[pd.Series]:
+    c = conn()
+    df = pd.read_sql_query("SELECT * FROM spaces WHERE key_number=?", c, params=[key_number])
+    return None if df.empty else df.iloc[0]
+
+def space_exists_and_active(key_number: int) -> bool:
+    c = conn()
+    cur = c.cursor()
+    cur.execute("SELECT 1 FROM spaces WHERE key_number=? AND is_active=1", (key_number,))
+    return cur.fetchone() is not None
+
+# ----- Helpers: Persons -----
+def add_person(name: str, id_code: str = "", phone: str = ""):
+    run_write(lambda c: c.execute("INSERT INTO persons(uid,name,id_code,phone,is_active) VALUES(?,?,?,?,1)",
+                                  (str(uuid.uuid4()), name, id_code, phone)))
+
+def list_persons(active_only=True):
+    c = conn()
+    if active_only:
+        return pd.read_sql_query("SELECT * FROM persons WHERE is_active=1 ORDER BY name", c)
+    return pd.read_sql_query("SELECT * FROM persons ORDER BY name", c)
+
+def update_person(person_id: int, name: str, id_code: str, phone: str, is_active: int):
+    run_write(lambda c: c.execute("UPDATE persons SET name=?, id_code=?, phone=?, is_active=? WHERE id=?",
+                                  (name, id_code, phone, int(is_active), int(person_id))))
+
+def get_person(pid: str) -> Optional[pd.Series]:
+    """Pessoa pelo uid (o pid das URLs de QR)."""
+    df = list_persons(active_only=False)
+    if df.empty: return None
+    row = df[df["uid"] == pid]
+    return None if row.empty else row.iloc[0]
+
+# ----- Helpers: Autorizações -----
+def add_authorization(key_number:int, memo_number:str, valid_from:Optional[datetime.date], valid_to:Optional[datetime.date]) -> int:
+    return run_write(lambda c: c.execute("""INSERT INTO authorizations(key_number,memo_number,valid_from,valid_to,created_at)
+                     VALUES(?,?,?,?,?)""",
+                  (key_number, memo_number,
+                   datetime.datetime.combine(valid_from, datetime.time.min).isoformat(timespec="seconds") if valid_from else None,
+                   datetime.datetime.combine(valid_to,   datetime.time.max).isoformat(timespec="seconds") if valid_to   else None,
+                   now_iso())).lastrowid)
+
+def list_authorizations(key_number:int=None) -> pd.DataFrame:
+    c = conn()
+    q = "SELECT * FROM authorizations"; p = []
+    if key_number is not None:
+        q += " WHERE key_number=?"; p.append(key_number)
+    q += " ORDER BY created_at DESC"
+    return pd.read_sql_query(q, c, params=p)
+
+def add_person_to_authorization(authorization_id:int, person_id:int):
+    run_write(lambda c: c.execute("""INSERT INTO authorization_people(authorization_id,person_id)
+                     VALUES(?,?)""", (int(authorization_id), int(person_id))))
+
+def list_authorized_people_now(key_number:int) -> pd.DataFrame:
+    c = conn()
+    now = now_iso()
+    q = """
+    SELECT p.*
+    FROM persons p
+    JOIN authorization_people ap ON ap.person_id = p.id
+    JOIN authorizations a ON a.id = ap.authorization_id
+    WHERE a.key_number = ?
+      AND (a.valid_from IS NULL OR datetime(a.valid_from) <= datetime(?))
+      AND (a.valid_to   IS NULL OR datetime(a.valid_to)   >= datetime(?))
+      AND p.is_active = 1
+    """
+    return pd.read_sql_query(q, c, params=[key_number, now, now])
+
+# ----- Helpers: Tokens -----
+# Token assinado: "t1.<payload>.<hmac>", payload = ação|chave(s)|pessoa|expira(unix)|nonce;
+# token de lote leva as chaves separadas por vírgula ("12,13,14") e só vale para o lote inteiro.
+# Emitir não faz I/O; só o consumo grava (qr_used).
+SIGNED_TOKEN_PREFIX = "t1."
+_TOKEN_ACTIONS = {"retirar": "r", "devolver": "d"}
+_token_secrets = {}
+
+def _token_secret() -> bytes:
+    if QR_TOKEN_SECRET:
+        return QR_TOKEN_SECRET.encode("utf-8")
+    key = _token_secrets.get(DB_PATH)
+    if key is None:
+        c = conn()
+        key = _token_secrets[DB_PATH] = bytes.fromhex(
+            c.execute("SELECT value FROM app_settings WHERE name='qr_token_secret'").fetchone()[0])
+    return key
+
+def _token_sig(body: str) -> str:
+    return _b64(hmac.new(_token_secret(), body.encode("ascii"), hashlib.sha256).digest()[:16])
+
+def _token_keys(key_number: Union[int, Sequence[int]]) -> Tuple[int, ...]:
+    if isinstance(key_number, (list, tuple, set)):
+        return tuple(sorted({int(k) for k in key_number}))
+    return (int(key_number),)
+
+def _parse_signed_token(token: str) -> Optional[Tuple[str, Tuple[int, ...], Optional[str], datetime.datetime, str]]:
+    """(ação, chaves, pessoa, expira, assinatura) de um token íntegro; None se inválido."""
+    try:
+        body, sig = token[len(SIGNED_TOKEN_PREFIX):].split(".")
+        if not hmac.compare_digest(sig, _token_sig(body)):
+            return None
+        act, keyn, pid, exp, _nonce = _unb64(body).decode("utf-8").split("|")
+        action = {v: k for k, v in _TOKEN_ACTIONS.items()}[act]
+        return action, _token_keys(keyn.split(",")), (pid or None), datetime.datetime.fromtimestamp(int(exp)), sig
+    except Exception:
+        return None
+
+def create_qr_token(action: str, key_number: Union[int, Sequence[int]], person_id: Optional[str],
+                    ttl_minutes: int = TOKEN_TTL_MINUTES) -> Tuple[str, datetime.datetime]:
+    """Token de uso único; com uma lista de chaves, token de lote (batch_checkout/batch_checkin)."""
+    assert action in ("retirar", "devolver")
+    keys = _token_keys(key_number)
+    assert 0 < len(keys) <= BATCH_MAX_KEYS
+    exp = (datetime.datetime.now() + datetime.timedelta(minutes=int(ttl_minutes))).replace(microsecond=0)
+    payload = "|".join([_TOKEN_ACTIONS[action], ",".join(map(str, keys)), person_id or "",
+                        str(int(exp.timestamp())), secrets.token_hex(3)])
+    body = _b64(payload.encode("utf-8"))
+    return f"{SIGNED_TOKEN_PREFIX}{body}.{_token_sig(body)}", exp
+
+def validate_qr_token(token: str, action: str, key_number: Union[int, Sequence[int]],
+                      person_id: Optional[str] = None) -> Tuple[bool, str]:
+    """Valida sem consumir; retorna (ok, msg_erro). Com uma lista, o token precisa ser do mesmo lote."""
+    c = conn()
+    cur = c.cursor()
+    if token.startswith(SIGNED_TOKEN_PREFIX):
+        parsed = _parse_signed_token(token)
+        if parsed is None:
+            return False, "Token inválido."
+        act, keys, pid, exp, sig = parsed
+        cur.execute("SELECT used_at FROM qr_used WHERE sig=?", (sig,))
+        row = cur.fetchone()
+        used = row[0] if row else None
+    else:
+        cur.execute("""SELECT q.action, q.key_number, p.uid, q.expires_at, q.used_at
+                       FROM qr_tokens q LEFT JOIN persons p ON p.id = q.person_id WHERE q.token=?""", (token,))
+        row = cur.fetchone()
+        if not row:
+            return False, "Token inválido."
+        act, keyn, pid, exp, used = row
+        keys = (int(keyn),)
+    if act != action:
+        return False, "Token não corresponde a esta operação."
+    if keys != _token_keys(key_number):
+        return False, "Token não corresponde a esta chave." if len(keys) == 1 else "Token não corresponde a este lote de chaves."
+    if person_id is not None and pid != person_id:
+        return False, "Token não corresponde à pessoa autorizada."
+    try:
+        if used is not None:
+            return False, "Token já utilizado."
+        if datetime.datetime.now() > datetime.datetime.fromisoformat(str(exp)):
+            return False, "Token expirado."
+    except Exception:
+        return False, "Falha ao validar o token."
+    return True, ""
+
+def consume_qr_token(token: str) -> bool:
+    """Marca o token como usado; False se outra leitura já o consumiu."""
+    if token.startswith(SIGNED_TOKEN_PREFIX):
+        parsed = _parse_signed_token(token)
+        if parsed is None:
+            return False
+        _, keys, _, exp, sig = parsed
+
+        def _job(c):
+            c.execute("DELETE FROM qr_used WHERE expires_at < ?", (now_iso(),))  # expirados não validam mais
+            return c.execute("""INSERT OR IGNORE INTO qr_used(sig, key_number, expires_at, used_at) VALUES(?,?,?,?)""",
+                             (sig, keys[0], exp.isoformat(timespec="seconds"), now_iso())).rowcount == 1
+        return run_write(_job)
+    return run_write(lambda c: c.execute("UPDATE qr_tokens SET used_at=? WHERE token=? AND used_at IS NULL",
+                                         (now_iso(), token)).rowcount == 1)
+
+def release_qr_token(token: str):
+    """Desfaz consume_qr_token quando a operação que o token autorizava falhou."""
+    if token.startswith(SIGNED_TOKEN_PREFIX):
+        parsed = _parse_signed_token(token)
+        if parsed is not None:
+            run_write(lambda c: c.execute("DELETE FROM qr_used WHERE sig=?", (parsed[4],)))
+    else:
+        run_write(lambda c: c.execute("UPDATE qr_tokens SET used_at=NULL WHERE token=?", (token,)))
+
+# ----- Operação / Transactions -----
+def has_open_checkout(key_number: int) -> bool:
+    c = conn()
+    cur = c.cursor()
+    cur.execute("""SELECT 1 FROM transactions 
+                   WHERE key_number=? AND checkin_time IS NULL
+                   LIMIT 1""", (key_number,))
+    return cur.fetchone() is not None
+
+def open_checkout(key_number: int, name: str, id_code: str, phone: str,
+                  due_time: Optional[datetime.datetime], signature_png: Optional[bytes]) -> Tuple[bool, str]:
+    if not space_exists_and_active(key_number):
+        return False, f"A chave {key_number} não está cadastrada como ATIVA. Cadastre/ative em Cadastros → Espaços."
+    name = (name or "").strip()
+    if not name:
+        return False, "Informe o nome de quem está retirando a chave."
+    if has_open_checkout(key_number):
+        return False, "Esta chave já está EM USO. Faça a devolução antes de nova retirada."
+    uid = str(uuid.uuid4())
+    co_iso = now_iso()
+    due_iso = due_time.isoformat(timespec="seconds") if due_time else None
+
+    def _job(c):
+        # revalida dentro da fila: duas estações podem ter passado pela checagem acima
+        if c.execute("""SELECT 1 FROM transactions WHERE key_number=? AND checkin_time IS NULL LIMIT 1""",
+                     (key_number,)).fetchone():
+            return False, "Esta chave já está EM USO. Faça a devolução antes de nova retirada."
+        c.execute("""INSERT INTO transactions
+                     (uid,key_number,taken_by_name,taken_by_id,taken_phone,checkout_time,due_time,checkin_time,status,signature_out,signature_in)
+                     VALUES(?,?,?,?,?,?,?,?,?,?,?)""",
+                  (uid, key_number, name, (id_code or "").strip(), (phone or "").strip(),
+                   co_iso, due_iso, None, "EM_USO", signature_png, None))
+        return True, c.execute("SELECT last_insert_rowid()").fetchone()[0]
+    try:
+        ok, res = run_write(_job)
+    except _sqlite3.IntegrityError:
+        return False, "Não foi possível registrar a retirada. Verifique se a chave existe/está ativa e os campos obrigatórios."
+    if not ok:
+        return False, res
+    _schedule_overdue(res, overdue_deadline(co_iso, due_iso))
+    return True, uid
+
+def do_checkin(key_number: int, signature_png: Optional[bytes]) -> Tuple[bool, str]:
+    if not space_exists_and_active(key_number):
+        return False, f"A chave {key_number} não está cadastrada/ativa. Cadastre/ative em Cadastros → Espaços."
+
+    def _job(c):
+        row = c.execute("""SELECT id, uid FROM transactions 
+                           WHERE key_number=? AND checkin_time IS NULL
+                           ORDER BY checkout_time DESC LIMIT 1""", (key_number,)).fetchone()
+        if not row:
+            return False, "Não há retirada em aberto para esta chave."
+        (tid, uid), ci = row, now_iso()
+        c.execute("""UPDATE transactions SET checkin_time=?, status=?, signature_in=? WHERE id=?""",
+                  (ci, "DEVOLVIDA", signature_png, tid))
+        c.execute("UPDATE overdue_events SET resolved_at=? WHERE transaction_id=? AND resolved_at IS NULL", (ci, tid))
+        _rollup_closed(c, tid)
+        return True, uid
+    return run_write(_job)
+
+# ----- Operação em lote (várias chaves, um responsável, uma assinatura) -----
+# Resultado por chave: {"key_number", "ok", "protocol", "error"}. Tudo ou nada: se alguma chave
+# for recusada nada é gravado: todas voltam com ok=False, as demais com error=BATCH_ABORTED.
+BATCH_ABORTED = "Não gravada: outra chave do lote foi recusada."
+
+def _batch_keys(key_numbers: Sequence[int]) -> Tuple[Optional[List[int]], str]:
+    keys = list(dict.fromkeys(int(k) for k in key_numbers))  # sem repetidas, na ordem informada
+    if not keys:
+        return None, "Selecione ao menos uma chave."
+    if len(keys) > BATCH_MAX_KEYS:
+        return None, f"No máximo {BATCH_MAX_KEYS} chaves por lote."
+    return keys, ""
+
+def _batch_state(c: sqlite3.Connection, keys: List[int]) -> Dict[int, Tuple[int, Optional[int], Optional[str]]]:
+    """Uma consulta para o lote todo: chave -> (ativa, id e uid da retirada em aberto)."""
+    rows = c.execute(f"""SELECT s.key_number, s.is_active, t.id, t.uid
+                         FROM spaces s
+                         LEFT JOIN transactions t ON t.key_number = s.key_number AND t.checkin_time IS NULL
+                         WHERE s.key_number IN ({",".join("?" * len(keys))})
+                         ORDER BY t.checkout_time""", keys).fetchall()
+    return {k: (active, tid, uid) for k, active, tid, uid in rows}  # a mais recente fica por último
+
+def _batch_result(keys: List[int], errors: Dict[int, str], protocols: Dict[int, str]) -> Tuple[bool, List[dict]]:
+    ok = not errors
+    return ok, [{"key_number": k, "ok": ok,
+                 "protocol": protocols.get(k) if ok else None,
+                 "error": errors.get(k) or (None if ok else BATCH_ABORTED)} for k in keys]
+
+def _batch_fail(key_numbers: Sequence[int], msg: str) -> Tuple[bool, List[dict]]:
+    """Recusa do lote inteiro (token, pessoa, tamanho): a mesma mensagem em todas as chaves."""
+    return False, [{"key_number": k, "ok": False, "protocol": None, "error": msg}
+                   for k in dict.fromkeys(int(k) for k in key_numbers)]
+
+def _store_signature(c: sqlite3.Connection, signature_png: Optional[bytes]) -> Optional[int]:
+    if not signature_png:
+        return None
+    return c.execute("INSERT INTO signatures(png, created_at) VALUES(?,?)", (signature_png, now_iso())).lastrowid
+
+def batch_checkout(key_numbers: Sequence[int], name: str, id_code: str, phone: str,
+                   due_time: Optional[datetime.datetime], signature_png: Optional[bytes]) -> Tuple[bool, List[dict]]:
+    """Retirada de várias chaves por um responsável, numa transação só."""
+    keys, msg = _batch_keys(key_numbers)
+    if keys is None:
+        return _batch_fail(key_numbers, msg)
+    name = (name or "").strip()
+    if not name:
+        return _batch_result(keys, {k: "Informe o nome de quem está retirando as chaves." for k in keys}, {})
+    co_iso = now_iso()
+    due_iso = due_time.isoformat(timespec="seconds") if due_time else None
+
+    def _job(c):
+        state = _batch_state(c, keys)
+        errors = {}
+        for k in keys:
+            if k not in state or int(state[k][0] or 0) != 1:
+                errors[k] = f"A chave {k} não está cadastrada como ATIVA."
+            elif state[k][1] is not None:
+                errors[k] = f"A chave {k} já está EM USO."
+        if errors:
+            return _batch_result(keys, errors, {}), {}
+        sig_id = _store_signature(c, signature_png)
+        protocols, tids = {}, {}
+        for k in keys:
+            protocols[k] = str(uuid.uuid4())
+            tids[k] = c.execute("""INSERT INTO transactions
+                         (uid,key_number,taken_by_name,taken_by_id,taken_phone,checkout_time,due_time,checkin_time,status,signature_out_id)
+                         VALUES(?,?,?,?,?,?,?,?,?,?)""",
+                      (protocols[k], k, name, (id_code or "").strip(), (phone or "").strip(),
+                       co_iso, due_iso, None, "EM_USO", sig_id)).lastrowid
+        return _batch_result(keys, {}, protocols), tids
+    (ok, results), tids = run_write(_job)
+    deadline = overdue_deadline(co_iso, due_iso)
+    for tid in tids.values():
+        _schedule_overdue(tid, deadline)
+    return ok, results
+
+def batch_checkin(key_numbers: Sequence[int], signature_png: Optional[bytes]) -> Tuple[bool, List[dict]]:
+    """Devolução de várias chaves numa transação só (uma assinatura para todas)."""
+    keys, msg = _batch_keys(key_numbers)
+    if keys is None:
+        return _batch_fail(key_numbers, msg)
+
+    def _job(c):
+        state = _batch_state(c, keys)
+        errors = {}
+        for k in keys:
+            if k not in state or int(state[k][0] or 0) != 1:
+                errors[k] = f"A chave {k} não está cadastrada/ativa."
+            elif state[k][1] is None:
+                errors[k] = f"Não há retirada em aberto para a chave {k}."
+        if errors:
+            return _batch_result(keys, errors, {})
+        sig_id = _store_signature(c, signature_png)
+        ci = now_iso()
+        for k in keys:
+            tid = state[k][1]
+            c.execute("""UPDATE transactions SET checkin_time=?, status=?, signature_in_id=? WHERE id=?""",
+                      (ci, "DEVOLVIDA", sig_id, tid))
+            c.execute("UPDATE overdue_events SET resolved_at=? WHERE transaction_id=? AND resolved_at IS NULL", (ci, tid))
+            _rollup_closed(c, tid)
+        return _batch_result(keys, {}, {k: state[k][2] for k in keys})
+    return run_write(_job)
+
+def get_signature(protocol: str, direction: str = "out") -> Optional[bytes]:
+    """PNG da assinatura de retirada ('out') ou devolução ('in'), gravada na linha ou no lote."""
+    assert direction in ("out", "in")
+    row = conn().execute(f"""SELECT COALESCE(t.signature_{direction}, s.png) FROM transactions t
+                             LEFT JOIN signatures s ON s.id = t.signature_{direction}_id
+                             WHERE t.uid=?""", (protocol,)).fetchone()
+    return row[0] if row else None
+
+# ----- Fluxos via QR (Streamlit público e scan_api.py) -----
+def qr_checkout_person(key_number: int, pid: str) -> Tuple[Optional[pd.Series], str]:
+    """Pessoa que pode retirar via QR; retorna (pessoa, msg_erro)."""
+    # Política: token pode dispensar autorização vigente.
+    # Quando QR_CHECK_AUTH_ON_CHECKOUT = false, o fluxo de QR não barra pela autorização — exige apenas token válido
+    if QR_CHECK_AUTH_ON_CHECKOUT:
+        df_auth_now = list_authorized_people_now(key_number)
+        if df_auth_now.empty or not (df_auth_now["uid"] == pid).any():
+            return None, "Você não está autorizado(a) a retirar esta chave neste período."
+        return df_auth_now[df_auth_now["uid"] == pid].iloc[0], ""
+    # Não exigir autorização: token emitido pelo gestor já vale como autorização
+    person = get_person(pid)
+    if person is None or (("is_active" in person.index) and (int(person["is_active"]) != 1)):
+        return None, "Pessoa não encontrada ou inativa."
+    return person, ""
+
+def _run_claimed(token: Optional[str], fn: Callable[..., Tuple[bool, Any]], *args) -> Tuple[bool, Any]:
+    """Roda a operação autorizada por um token já consumido; libera o token se ela
+    recusar ou levantar erro (ex.: banco ocupado), para que a nova tentativa valha."""
+    try:
+        ok, res = fn(*args)
+    except BaseException:
+        if token:
+            try:
+                release_qr_token(token)
+            except Exception:
+                pass  # mantém o erro original
+        raise
+    if not ok and token:
+        release_qr_token(token)
+    return ok, res
+
+def qr_checkin(key_number: int, token: Optional[str], signature_png: Optional[bytes]) -> Tuple[bool, str]:
+    """Devolução via QR: token opcional, mas se vier precisa ser válido; consumido
+    antes da operação (uso único mesmo com leituras simultâneas) e liberado se ela falhar."""
+    if not space_exists_and_active(key_number):
+        return False, "Chave não cadastrada/ativa."
+    if token:
+        ok, msg = validate_qr_token(token, "devolver", key_number, None)
+        if not ok:
+            return False, msg
+        if not consume_qr_token(token):
+            return False, "Token já utilizado."
+    return _run_claimed(token, do_checkin, key_number, signature_png)
+
+def qr_checkout(key_number: int, pid: str, token: Optional[str],
+                due_time: Optional[datetime.datetime], signature_png: Optional[bytes]) -> Tuple[bool, str]:
+    """Retirada via QR: pessoa específica (pid) e token obrigatório; consumido como em qr_checkin."""
+    if not space_exists_and_active(key_number):
+        return False, "Chave não cadastrada/ativa."
+    if not token:
+        return False, "Token ausente. Solicite um novo QR ao gestor."
+    ok, msg = validate_qr_token(token, "retirar", key_number, pid)
+    if not ok:
+        return False, msg
+    prow, msg = qr_checkout_person(key_number, pid)
+    if prow is None:
+        return False, msg
+    if not consume_qr_token(token):
+        return False, "Token já utilizado."
+    return _run_claimed(token, open_checkout, key_number, prow["name"], prow["id_code"], prow["phone"],
+                        due_time, signature_png)
+
+def qr_batch_checkin(key_numbers: Sequence[int], token: Optional[str],
+                     signature_png: Optional[bytes]) -> Tuple[bool, List[dict]]:
+    """Devolução em lote via QR: como qr_checkin, com token (opcional) do lote inteiro."""
+    if token:
+        ok, msg = validate_qr_token(token, "devolver", list(key_numbers), None)
+        if not ok:
+            return _batch_fail(key_numbers, msg)
+        if not consume_qr_token(token):
+            return _batch_fail(key_numbers, "Token já utilizado.")
+    return _run_claimed(token, batch_checkin, key_numbers, signature_png)
+
+def qr_batch_checkout(key_numbers: Sequence[int], pid: str, token: Optional[str],
+                      due_time: Optional[datetime.datetime], signature_png: Optional[bytes]) -> Tuple[bool, List[dict]]:
+    """Retirada em lote via QR: token obrigatório, emitido para essa pessoa e exatamente essas chaves."""
+    if not token:
+        return _batch_fail(key_numbers, "Token ausente. Solicite um novo QR ao gestor.")
+    ok, msg = validate_qr_token(token, "retirar", list(key_numbers), pid)
+    if not ok:
+        return _batch_fail(key_numbers, msg)
+    keys = list(dict.fromkeys(int(k) for k in key_numbers))
+    errors, prow = {}, None
+    for k in keys:  # autorização vale por chave (QR_CHECK_AUTH_ON_CHECKOUT)
+        person, msg = qr_checkout_person(k, pid)
+        if person is None:
+            errors[k] = msg
+        prow = person if prow is None else prow
+    if errors:
+        return _batch_result(keys, errors, {})
+    if not consume_qr_token(token):
+        return _batch_fail(key_numbers, "Token já utilizado.")
+    return _run_claimed(token, batch_checkout, key_numbers, prow["name"], prow["id_code"], prow["phone"],
+                        due_time, signature_png)
+
+def overdue_deadline(checkout_time, due_time) -> Optional[datetime.datetime]:
+    """Momento em que uma retirada em aberto vira ATRASADA: o que vier primeiro
+    entre due_time e o corte CUTOFF_HOUR_FOR_OVERDUE do dia da retirada."""
+    deadlines = []
+    if due_time is not None and not pd.isna(due_time):
+        try:
+            deadlines.append(datetime.datetime.fromisoformat(str(due_time)))
+        except Exception:
+            pass
+    try:
+        co = datetime.datetime.fromisoformat(str(checkout_time))
+        limit = co.replace(hour=CUTOFF_HOUR_FOR_OVERDUE, minute=0, second=0, microsecond=0)
+        if limit < co: limit = limit + datetime.timedelta(days=1)
+        deadlines.append(limit)
+    except Exception:
+        pass
+    return min(deadlines) if deadlines else None
+
+def list_status(c: Optional[sqlite3.Connection] = None, keys: Optional[List[int]] = None,
+                from_snapshot: bool = False) -> pd.DataFrame:
+    """Status por chave; com keys, só dessas chaves (usado pelo painel ao vivo).
+    Com from_snapshot, ATRASADA vem do snapshot do monitor (overdue_events) em vez de
+    recalcular o prazo de cada retirada em aberto."""
+    c = c or conn()
+    df_space = list_spaces(active_only=True, c=c)  # inclui category
+    key_filter, params = "", []
+    if keys is not None:
+        keys = sorted({int(k) for k in keys})
+        df_space = df_space[df_space["key_number"].isin(keys)]
+        key_filter = f"WHERE key_number IN ({','.join('?' * len(keys))})" if keys else "WHERE 0"
+        params = keys
+    df_tx = pd.read_sql_query(f"""
+        SELECT t.key_number, t.checkout_time, t.due_time, t.checkin_time, t.status AS last_status,
+               o.overdue_since
+        FROM transactions t
+        INNER JOIN (
+          SELECT key_number, MAX(checkout_time) AS max_co FROM transactions {key_filter} GROUP BY key_number
+        ) m ON t.key_number=m.key_number AND t.checkout_time=m.max_co
+        LEFT JOIN overdue_events o ON o.transaction_id = t.id AND o.resolved_at IS NULL
+    """, c, params=params)
+    df = df_space.merge(df_tx, on="key_number", how="left")
+    if df.empty:
+        return df.assign(status=pd.Series(dtype=object))[["key_number","room_name","location","category","status","checkout_time","due_time","checkin_time"]]
+
+    if from_snapshot:
+        is_open = df["checkout_time"].notna() & df["checkin_time"].isna()
+        df["status"] = "DISPONÍVEL"
+        df.loc[is_open, "status"] = "EM_USO"
+        df.loc[is_open & df["overdue_since"].notna(), "status"] = "ATRASADA"
+        return df[["key_number","room_name","location","category","status","checkout_time","due_time","checkin_time"]].sort_values("key_number")
+
+    def compute_status(row):
+        if pd.isna(row["checkout_time"]):
+            return "DISPONÍVEL"
+        if pd.isna(row["checkin_time"]):
+            deadline = overdue_deadline(row["checkout_time"], row["due_time"])
+            if deadline is not None and datetime.datetime.now() > deadline:
+                return "ATRASADA"
+            return "EM_USO"
+        return "DISPONÍVEL"
+
+    df["status"] = df.apply(compute_status, axis=1)
+    return df[["key_number","room_name","location","category","status","checkout_time","due_time","checkin_time"]].sort_values("key_number")
+
+# ----- Alterações (cursor) -----
+def current_cursor() -> int:
+    c = conn()
+    return int(c.execute("SELECT COALESCE(MAX(seq), 0) FROM change_log").fetchone()[0])
+
+def changes_since(cursor: int, limit: int = 1000) -> Tuple[int, pd.DataFrame, bool]:
+    """Alterações com seq > cursor, em ordem; retorna (novo_cursor, alterações, recarregar).
+    recarregar=True quando o cursor ficou para trás da poda (prune_change_log): o cliente
+    deve recarregar tudo e seguir do novo cursor."""
+    c = conn()
+    df = pd.read_sql_query("""SELECT seq, at, entity, op, key_number, ref FROM change_log
+                              WHERE seq > ? ORDER BY seq LIMIT ?""", c, params=[int(cursor), int(limit)])
+    df["key_number"] = df["key_number"].astype("Int64")  # NULL para pessoas, sem virar float
+    oldest = c.execute("SELECT MIN(seq) FROM change_log").fetchone()[0]
+    if oldest is not None and int(cursor) < oldest - 1:
+        return current_cursor(), df.iloc[0:0], True
+    return (int(df["seq"].iloc[-1]) if not df.empty else int(cursor)), df, False
+
+def _prune_change_log(c: sqlite3.Connection, keep: int) -> int:
+    return c.execute("DELETE FROM change_log WHERE seq <= (SELECT MAX(seq) FROM change_log) - ?",
+                     (max(int(keep), 1),)).rowcount
+
+def prune_change_log(keep: int = CHANGE_LOG_KEEP, path: Optional[str] = None) -> int:
+    """Apaga o change_log antigo, mantendo as últimas `keep` linhas; retorna quantas apagou.
+    A thread de escrita já faz isso a cada CHANGE_LOG_PRUNE_EVERY escritas."""
+    return run_write(_prune_change_log, keep, path=path)
+
+SEARCH_COLUMNS = ["key_number","room_name","location","taken_by_name","taken_by_id","taken_phone",
+                  "checkout_time","due_time","checkin_time","status","uid"]
+
+# visão pública: sem matrícula/telefone, nem como critério de busca nem no resultado
+PUBLIC_SEARCH_FIELDS = ("taken_by_name", "room_name", "location", "key_text")
+PRIVATE_SEARCH_COLUMNS = ("taken_by_id", "taken_phone")
+
+def search_transactions(text: str, limit: int = 200, public: bool = False) -> pd.DataFrame:
+    """Busca movimentações por nome, matrícula, telefone, sala/local ou nº da chave,
+    sem diferenciar acentos; resultados ordenados por relevância (bm25).
+    Com public=True, só por nome, sala/local e nº da chave (tela pública)."""
+    terms = re.findall(r"\w+", text or "")
+    columns = [col for col in SEARCH_COLUMNS if not (public and col in PRIVATE_SEARCH_COLUMNS)]
+    if not terms:
+        return pd.DataFrame(columns=columns)
+    cols = ", ".join(f"t.{col}" if col not in ("room_name", "location") else f"s.{col}" for col in columns)
+    c = conn()
+    try:
+        match = " ".join(f'"{t}"*' for t in terms)  # todos os termos, por prefixo
+        if public:
+            match = f"{{{' '.join(PUBLIC_SEARCH_FIELDS)}}} : ({match})"
+        return pd.read_sql_query(f"""
+            SELECT {cols}
+            FROM transactions_fts f
+            JOIN transactions t ON t.rowid = f.rowid
+            LEFT JOIN spaces s ON s.key_number = t.key_number
+            WHERE transactions_fts MATCH ?
+            ORDER BY bm25(transactions_fts)
+            LIMIT ?""", c, params=[match, int(limit)])
+    except Exception:
+        # sem FTS5: LIKE por termo (sensível a acentos, varre a tabela)
+        where = []; params: List[Any] = []
+        like_cols = ["t.taken_by_name", "s.room_name", "s.location"]
+        if not public:
+            like_cols += ["t.taken_by_id", "t.taken_phone"]
+        for t in terms:
+            where.append("(" + " OR ".join(f"{col} LIKE ?" for col in like_cols) + " OR CAST(t.key_number AS TEXT) = ?)")
+            params += [f"%{t}%"] * len(like_cols) + [t]
+        return pd.read_sql_query(f"""
+            SELECT {cols} FROM transactions t LEFT JOIN spaces s ON s.key_number = t.key_number
+            WHERE {" AND ".join(where)} ORDER BY t.checkout_time DESC LIMIT ?""", c, params=params + [int(limit)])
+
+USAGE_GROUPS = ("day", "hour", "key_number", "category", "person")
+
+def usage_rollup(group_by: str, start: Optional[datetime.date] = None,
+                 end: Optional[datetime.date] = None) -> pd.DataFrame:
+    """Uso agregado (usage_daily) por dia, hora, chave, categoria ou pessoa."""
+    if group_by not in USAGE_GROUPS:
+        raise ValueError(f"group_by deve ser um de {USAGE_GROUPS}")
+    c = conn()
+    sel = "u.key_number, COALESCE(s.room_name, '') AS room_name" if group_by == "key_number" else f"u.{group_by}"
+    q = f"""SELECT {sel}, SUM(u.uses) AS uses,
+                   ROUND(SUM(u.held_seconds) / 3600.0, 2) AS hours,
+                   SUM(u.overdue) AS overdue,
+                   ROUND(1.0 * SUM(u.overdue) / SUM(u.uses), 4) AS overdue_rate
+            FROM usage_daily u LEFT JOIN spaces s ON s.key_number = u.key_number"""
+    params: List[str] = []; where = []
+    if start:
+        where.append("u.day >= ?"); params.append(start.isoformat())
+    if end:
+        where.append("u.day <= ?"); params.append(end.isoformat())
+    if where:
+        q += " WHERE " + " AND ".join(where)
+    q += f" GROUP BY u.{group_by} ORDER BY u.{group_by}"
+    return pd.read_sql_query(q, c, params=params)
+
+def list_transactions(start: Optional[datetime.datetime] = None,
+                      end: Optional[datetime.datetime] = None,
+                      c: Optional[sqlite3.Connection] = None,
+                      columns: Optional[List[str]] = None) -> pd.DataFrame:
+    c = c or conn()
+    base_q = f"SELECT {', '.join(columns) if columns else '*'} FROM transactions"; params: List[str] = []; where = []
+    if start:
+        where.append("datetime(checkout_time) >= datetime(?)"); params.append(start.isoformat(timespec="seconds"))
+    if end:
+        where.append("datetime(COALESCE(checkin_time, checkout_time)) <= datetime(?)"); params.append(end.isoformat(timespec="seconds"))
+    if where:
+        base_q += " WHERE " + " AND ".join(where)
+    base_q += " ORDER BY checkout_time DESC"
+    return pd.read_sql_query(base_q, c, params=params)
+
+# -------------- Várias guaritas -----------
+def list_sites() -> List[Tuple[str, str]]:
+    """(nome, caminho) desta guarita e das demais em SITE_DBS."""
+    sites = [(SITE_NAME, DB_PATH)]
+    for item in SITE_DBS.split(";"):
+        name, sep, path = item.partition("=")
+        name, path = name.strip(), path.strip()
+        if sep and name and path and os.path.abspath(path) != os.path.abspath(DB_PATH):
+            sites.append((name, path))
+    return sites
+
+def _query_sites(fn: Callable[[sqlite3.Connection], pd.DataFrame]) -> Tuple[pd.DataFrame, dict]:
+    """Roda fn em todas as guaritas em paralelo (uma conexão somente leitura por thread)
+    e junta os resultados com a coluna 'site'. Retorna (df, {site: erro})."""
+    sites = list_sites()
+    init_db()  # garante o schema do banco local antes de abri-lo em modo ro
+
+    def _one(path):
+        c = conn_ro(path)
+        try:
+            return fn(c)
+        finally:
+            c.close()
+
+    frames, errors = [], {}
+    with ThreadPoolExecutor(max_workers=len(sites), thread_name_prefix="site-query") as ex:
+        futs = [(name, ex.submit(_one, path)) for name, path in sites]
+        for name, fut in futs:
+            try:
+                frames.append(fut.result().assign(site=name))
+            except Exception as e:
+                errors[name] = str(e)
+    if not frames:
+        return pd.DataFrame(columns=["site"]), errors
+    df = pd.concat(frames, ignore_index=True)
+    return df[["site"] + [col for col in df.columns if col != "site"]], errors
+
+def list_status_all_sites() -> Tuple[pd.DataFrame, dict]:
+    return _query_sites(lambda c: list_status(c))
+
+# sem as assinaturas: o relatório consolidado não mostra os PNGs
+SITE_TX_COLUMNS = ["id", "uid", "key_number", "taken_by_name", "taken_by_id", "taken_phone",
+                   "checkout_time", "due_time", "checkin_time", "status"]
+
+def list_transactions_all_sites(start: Optional[datetime.datetime] = None,
+                                end: Optional[datetime.datetime] = None) -> Tuple[pd.DataFrame, dict]:
+    df, errors = _query_sites(lambda c: list_transactions(start, end, c=c, columns=SITE_TX_COLUMNS))
+    if "checkout_time" in df.columns:
+        df = df.sort_values("checkout_time", ascending=False, ignore_index=True)
+    return df, errors
+
+# -------------- Monitor de atrasos ---------
+class OverdueMonitor:
+    """Thread que grava em overdue_events o momento em que cada retirada em aberto
+    fica ATRASADA. Acorda no próximo prazo (heap de deadlines) ou a cada
+    OVERDUE_REFRESH_S, quando relê só as retiradas em aberto (inclusive as feitas
+    por outros processos, como o scan_api.py)."""
+
+    def __init__(self, path: str, refresh_s: int = OVERDUE_REFRESH_S):
+        self.path = path
+        self.refresh_s = refresh_s
+        self.heap: List[Tuple[datetime.datetime, int]] = []
+        self.cv = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name="overdue-monitor", daemon=True)
+        self.thread.start()
+
+    def schedule(self, tid: int, deadline: Optional[datetime.datetime]):
+        if deadline is None:
+            return
+        with self.cv:
+            heapq.heappush(self.heap, (deadline, tid))
+            self.cv.notify()
+
+    def _reload(self):
+        init_db(self.path)
+        c = _connect(self.path)
+        try:
+            rows = c.execute("""SELECT id, checkout_time, due_time FROM transactions
+                                WHERE checkin_time IS NULL
+                                  AND id NOT IN (SELECT transaction_id FROM overdue_events)""").fetchall()
+        finally:
+            c.close()
+        fresh = {(dl, tid) for tid, co, due in rows if (dl := overdue_deadline(co, due)) is not None}
+        with self.cv:
+            # mantém o que foi agendado durante a leitura; duplicatas caem no INSERT OR IGNORE
+            self.heap = list(fresh | set(self.heap))
+            heapq.heapify(self.heap)
+        # devoluções gravadas por versões/processos que não fecham o evento
+        run_write(lambda c: c.execute("""
+            UPDATE overdue_events
+               SET resolved_at = (SELECT t.checkin_time FROM transactions t WHERE t.id = overdue_events.transaction_id)
+             WHERE resolved_at IS NULL
+               AND transaction_id IN (SELECT id FROM transactions WHERE checkin_time IS NOT NULL)"""), path=self.path)
+
+    def _record(self, due: List[Tuple[datetime.datetime, int]]):
+        detected = now_iso()
+        def _job(c):
+            for deadline, tid in due:
+                c.execute("""INSERT OR IGNORE INTO overdue_events
+                             (transaction_id, key_number, taken_by_name, overdue_since, detected_at, resolved_at)
+                             SELECT id, key_number, taken_by_name, ?, ?, NULL
+                             FROM transactions WHERE id=? AND checkin_time IS NULL""",
+                          (deadline.isoformat(timespec="seconds"), detected, tid))
+        run_write(_job, path=self.path)
+
+    def _run(self):
+        next_reload = 0.0
+        while True:
+            try:
+                if time.monotonic() >= next_reload:
+                    self._reload()
+                    next_reload = time.monotonic() + self.refresh_s
+                with self.cv:
+                    now = datetime.datetime.now()
+                    due = []
+                    while self.heap and self.heap[0][0] <= now:
+                        due.append(heapq.heappop(self.heap))
+                    if not due:
+                        wait = next_reload - time.monotonic()
+                        if self.heap:
+                            wait = min(wait, (self.heap[0][0] - now).total_seconds())
+                        self.cv.wait(max(wait, 0.05))
+                        continue
+                self._record(due)
+            except Exception:
+                # banco ocupado/indisponível: tenta de novo no próximo ciclo
+                time.sleep(1)
+                next_reload = 0.0
+
+_monitors = {}
+
+def start_overdue_monitor(refresh_s: int = OVERDUE_REFRESH_S) -> OverdueMonitor:
+    """Inicia (uma vez por processo e por banco) o monitor de atrasos."""
+    path = DB_PATH
+    with _writers_lock:
+        m = _monitors.get(path)
+        if m is None:
+            m = _monitors[path] = OverdueMonitor(path, refresh_s)
+    return m
+
+def _schedule_overdue(tid: int, deadline: Optional[datetime.datetime]):
+    m = _monitors.get(DB_PATH)
+    if m is not None:
+        m.schedule(tid, deadline)
+
+def list_overdue(current_only: bool = True) -> pd.DataFrame:
+    """Lê o snapshot do monitor (current_only) ou o histórico completo de atrasos."""
+    c = conn()
+    q = """SELECT o.key_number, s.room_name, s.category, o.taken_by_name,
+                  o.overdue_since, o.detected_at, o.resolved_at, o.transaction_id
+           FROM overdue_events o LEFT JOIN spaces s ON s.key_number = o.key_number"""
+    if current_only:
+        q += " WHERE o.resolved_at IS NULL"
+    q += " ORDER BY o.overdue_since DESC"
+    return pd.read_sql_query(q, c)
+
+# -------------- Backup online --------------
+_backup_lock = threading.Lock()
+_backup_status = {"last_path": None, "last_at": None, "last_error": None, "last_seconds": None}
+
+def _backup_prefix() -> str:
+    return os.path.splitext(os.path.basename(DB_PATH))[0]
+
+def backup_now(dest_dir: Optional[str] = None, keep: Optional[int] = None) -> str:
+    """Snapshot com a API de backup online do SQLite, num passo só: em WAL essa leitura não
+    bloqueia o escritor, e em vários passos cada escrita do app reiniciaria a cópia.
+    Verificado com integrity_check, comprimido (.db.gz) e com rotação dos mais antigos.
+    Retorna o caminho do snapshot."""
+    dest_dir = dest_dir or BACKUP_DIR
+    keep = BACKUP_KEEP if keep is None else keep
+    os.makedirs(dest_dir, exist_ok=True)
+    now = datetime.datetime.now()
+    stamp = now.strftime("%Y%m%d-%H%M%S-") + f"{now.microsecond // 1000:03d}"
+    final = os.path.join(dest_dir, f"{_backup_prefix()}-{stamp}.db.gz")
+    tmp = os.path.join(dest_dir, f".{_backup_prefix()}-{stamp}.db.tmp")
+    t0 = time.perf_counter()
+    with _backup_lock:
+        try:
+            src = _connect(DB_PATH); dst = sqlite3.connect(tmp)  # própria: é fechada no fim
+            try:
+                src.backup(dst)  # pages=-1: cópia inteira numa transação de leitura
+                check = dst.execute("PRAGMA integrity_check").fetchone()[0]
+            finally:
+                dst.close(); src.close()
+            if check != "ok":
+                raise RuntimeError(f"Snapshot reprovado no integrity_check: {check}")
+            with open(tmp, "rb") as f_in, gzip.open(final + ".part", "wb", compresslevel=6) as f_out:
+                shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+            os.replace(final + ".part", final)
+        except Exception as e:
+            _backup_status.update(last_error=str(e), last_at=now_iso())
+            if os.path.exists(final + ".part"): os.remove(final + ".part")
+            raise
+        finally:
+            if os.path.exists(tmp): os.remove(tmp)
+        for old in list_backups(dest_dir)[keep:] if keep > 0 else []:
+            os.remove(old)
+        _backup_status.update(last_path=final, last_at=now_iso(), last_error=None,
+                              last_seconds=round(time.perf_counter() - t0, 2))
+    return final
+
+def list_backups(dest_dir: Optional[str] = None) -> List[str]:
+    """Snapshots deste banco, do mais novo para o mais antigo. Só nomes <prefixo>-<data>-<hora>-<ms>.db.gz:
+    keys-test.db no mesmo BACKUP_DIR não entra na rotação nem no download de keys.db."""
+    prefix = _backup_prefix()
+    stamp = re.compile(re.escape(prefix) + r"-\d{8}-\d{6}-\d{3}\.db\.gz$")
+    paths = glob.glob(os.path.join(dest_dir or BACKUP_DIR, f"{glob.escape(prefix)}-[0-9]*-*.db.gz"))
+    return sorted((p for p in paths if stamp.match(os.path.basename(p))), reverse=True)
+
+def backup_status() -> dict:
+    return dict(_backup_status)
+
+_backup_thread: Optional[threading.Thread] = None
+
+def start_backup_scheduler(interval_min: int = BACKUP_INTERVAL_MIN) -> Optional[threading.Thread]:
+    """Inicia (uma vez por processo) o backup periódico; interval_min <= 0 desliga."""
+    global _backup_thread
+    if interval_min <= 0:
+        return None
+    with _writers_lock:
+        if _backup_thread is None:
+            def _loop():
+                while True:
+                    time.sleep(interval_min * 60)
+                    try:
+                        backup_now()
+                    except Exception:
+                        pass  # registrado em backup_status(); tenta no próximo ciclo
+            _backup_thread = threading.Thread(target=_loop, name="db-backup", daemon=True)
+            _backup_thread.start()
+    return _backup_thread
@@ -0,0 +1,178 @@
+# ==========================================
+# Guarita - Controle de Chaves :: teste de carga da camada de dados
+# Simula guaritas (retirada/devolução) e leituras públicas de QR em várias
+# threads e processos, chamando as funções reais de db.py.
+# Uso: python loadtest.py --processes 2 --threads 8 --duration 20
+#      python loadtest.py --mix checkout=3,checkin=3,token=2,validate=4,consume=1,status=1 --json
+# ==========================================
+import os, sys, json, time, random, sqlite3, argparse, tempfile
+import multiprocessing as mp
+from typing import Dict, List
+
+OPS = ("checkout", "checkin", "token", "validate", "consume", "status")
+DEFAULT_MIX = "checkout=3,checkin=3,token=2,validate=4,consume=1,status=1"
+
+def parse_mix(text: str) -> Dict[str, int]:
+    mix = {}
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name not in OPS:
+            raise SystemExit(f"Operação desconhecida no --mix: {name!r} (use {', '.join(OPS)})")
+        mix[name] = int(weight or 1)
+    return mix
+
+def setup_db(path: str, keys: int, persons: int):
+    import db
+    db.DB_PATH = path
+    for k in range(1, keys + 1):
+        db.add_space(k, f"Sala/Lab {k}", "", "Sala")
+    for i in range(persons):
+        db.add_person(f"Pessoa {i}", f"{100000 + i}", "")
+
+# -------------- Worker ---------------------
+def _worker_thread(db, mix_ops: List[str], mix_weights: List[int], keys: int, pids: List[str],
+                   deadline: float, seed: int, out: dict):
+    rnd = random.Random(seed)
+    tokens: List[tuple] = []  # (token, key) emitidos por esta thread
+    sig = b"\x89PNG" + b"\x00" * 2048  # assinatura típica (~2 KB)
+    while time.monotonic() < deadline:
+        op = rnd.choices(mix_ops, mix_weights)[0]
+        key = rnd.randint(1, keys)
+        t0 = time.perf_counter()
+        try:
+            if op == "checkout":
+                ok, _ = db.open_checkout(key, "Carga", "0", "", None, sig)
+            elif op == "checkin":
+                ok, _ = db.do_checkin(key, sig)
+            elif op == "token":
+                tok, _ = db.create_qr_token("retirar", key, rnd.choice(pids))
+                tokens.append((tok, key)); del tokens[:-50]
+                ok = True
+            elif op == "validate":
+                if not tokens:
+                    continue
+                tok, tkey = rnd.choice(tokens)
+                ok, _ = db.validate_qr_token(tok, "retirar", tkey)
+            elif op == "consume":
+                if not tokens:
+                    continue
+                tok, _ = tokens.pop(rnd.randrange(len(tokens)))
+                ok = db.consume_qr_token(tok)
+            else:
+                db.list_status(); ok = True
+            outcome = "ok" if ok else "rejected"  # rejected = regra de negócio (chave em uso, token usado...)
+        except sqlite3.OperationalError as e:
+            msg = str(e).lower()
+            outcome = "locked" if ("locked" in msg or "busy" in msg) else "error"
+        except Exception:
+            outcome = "error"
+        r = out.setdefault(op, {"lat": [], "ok": 0, "rejected": 0, "locked": 0, "error": 0})
+        r["lat"].append(time.perf_counter() - t0)
+        r[outcome] += 1
+
+def run_process(path: str, mix: Dict[str, int], threads: int, keys: int, duration: float, seed: int) -> dict:
+    """Um processo: várias threads compartilhando o mesmo db (e a mesma fila de escrita)."""
+    import threading
+    os.environ["DB_PATH"] = path
+    import db
+    db.DB_PATH = path
+    pids = db.list_persons()["uid"].tolist() or [None]
+    deadline = time.monotonic() + duration
+    results = [dict() for _ in range(threads)]
+    ts = [threading.Thread(target=_worker_thread,
+                           args=(db, list(mix), list(mix.values()), keys, pids, deadline, seed * 1000 + i, results[i]))
+          for i in range(threads)]
+    for t in ts: t.start()
+    for t in ts: t.join()
+    merged: dict = {}
+    for res in results:
+        for op, r in res.items():
+            m = merged.setdefault(op, {"lat": [], "ok": 0, "rejected": 0, "locked": 0, "error": 0})
+            m["lat"] += r["lat"]
+            for k in ("ok", "rejected", "locked", "error"):
+                m[k] += r[k]
+    merged["_writer"] = db.writer_stats()
+    return merged
+
+# -------------- Relatório ------------------
+def _pct(sorted_lat: List[float], p: float) -> float:
+    if not sorted_lat:
+        return 0.0
+    return sorted_lat[min(len(sorted_lat) - 1, int(round(p / 100 * (len(sorted_lat) - 1))))]
+
+def summarize(per_process: List[dict], elapsed: float) -> dict:
+    ops: dict = {}
+    for res in per_process:
+        for op, r in res.items():
+            if op.startswith("_"):
+                continue
+            m = ops.setdefault(op, {"lat": [], "ok": 0, "rejected": 0, "locked": 0, "error": 0})
+            m["lat"] += r["lat"]
+            for k in ("ok", "rejected", "locked", "error"):
+                m[k] += r[k]
+    report = {"elapsed_s": round(elapsed, 2), "ops": {}, "writers": [r.get("_writer") for r in per_process]}
+    total = 0
+    for op in OPS:
+        if op not in ops:
+            continue
+        m = ops[op]; lat = sorted(m["lat"]); n = len(lat); total += n
+        report["ops"][op] = {
+            "count": n,
+            "ops_per_s": round(n / elapsed, 1),
+            "p50_ms": round(1000 * _pct(lat, 50), 2),
+            "p99_ms": round(1000 * _pct(lat, 99), 2),
+            "max_ms": round(1000 * (lat[-1] if lat else 0), 2),
+            "rejected_rate": round(m["rejected"] / n, 4) if n else 0,
+            "lock_rate": round(m["locked"] / n, 4) if n else 0,
+            "error_rate": round(m["error"] / n, 4) if n else 0,
+        }
+    report["total_ops"] = total
+    report["total_ops_per_s"] = round(total / elapsed, 1)
+    return report
+
+def print_report(rep: dict):
+    print(f"\n{'operação':<10} {'n':>7} {'op/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'máx ms':>8} {'recus.':>7} {'lock':>7} {'erro':>7}")
+    for op, r in rep["ops"].items():
+        print(f"{op:<10} {r['count']:>7} {r['ops_per_s']:>8} {r['p50_ms']:>8} {r['p99_ms']:>8} {r['max_ms']:>8} "
+              f"{r['rejected_rate']:>7.2%} {r['lock_rate']:>7.2%} {r['error_rate']:>7.2%}")
+    print(f"\nTotal: {rep['total_ops']} operações em {rep['elapsed_s']} s ({rep['total_ops_per_s']} op/s)")
+    for i, w in enumerate(rep["writers"]):
+        if w:
+            print(f"Processo {i}: escritor {w['writes_per_s']} escritas/s, escrita média {w['avg_write_ms']} ms, "
+                  f"espera média na fila {w['avg_wait_ms']} ms, ocupação {w['utilization']:.1%}")
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Teste de carga das funções de db.py (threads x processos).")
+    ap.add_argument("--db", default=None, help="Arquivo SQLite. Padrão: banco temporário novo (não use o de produção).")
+    ap.add_argument("--processes", type=int, default=2, help="Processos (cada um com sua fila de escrita, como Streamlit + scan_api).")
+    ap.add_argument("--threads", type=int, default=8, help="Threads por processo (sessões simultâneas).")
+    ap.add_argument("--duration", type=float, default=15.0, help="Segundos de carga.")
+    ap.add_argument("--keys", type=int, default=50, help="Chaves cadastradas na preparação.")
+    ap.add_argument("--persons", type=int, default=50, help="Pessoas cadastradas na preparação.")
+    ap.add_argument("--mix", default=DEFAULT_MIX, help=f"Pesos das operações ({', '.join(OPS)}).")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--json", action="store_true", help="Imprime o relatório em JSON.")
+    args = ap.parse_args(argv)
+
+    mix = parse_mix(args.mix)
+    path = args.db or os.path.join(tempfile.mkdtemp(prefix="guarita-load-"), "load.db")
+    if not args.db or not os.path.exists(path):
+        setup_db(path, args.keys, args.persons)
+
+    ctx = mp.get_context("spawn")  # processos limpos: sem herdar threads/conexões do pai
+    with ctx.Pool(args.processes) as pool:
+        per_process = pool.starmap(run_process, [(path, mix, args.threads, args.keys, args.duration, args.seed + i)
+                                                 for i in range(args.processes)])
+    rep = summarize(per_process, args.duration)  # taxas sobre a janela de carga (sem o start dos processos)
+    rep["config"] = {"db": path, "processes": args.processes, "threads": args.threads, "mix": mix}
+    if args.json:
+        print(json.dumps(rep, ensure_ascii=False, indent=2))
+    else:
+        print(f"DB: {path} • {args.processes} processo(s) x {args.threads} thread(s) • mix {args.mix}")
+        print_report(rep)
+    total_bad = sum(r["lock_rate"] + r["error_rate"] for r in rep["ops"].values())
+    return 1 if total_bad > 0 else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,251 @@
+# ==========================================
+# Guarita - Controle de Chaves :: serviço leve de leitura de QR
+# (JSON: validate / checkin / checkout, de uma chave ou em lote + página estática de assinatura)
+# Uso: python scan_api.py --port 8502 [--db keys.db]
+# Roda ao lado do Streamlit, no mesmo arquivo SQLite (WAL).
+# ==========================================
+import os, json, base64, argparse, datetime, sqlite3
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from typing import Optional, Tuple, List
+import db
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+MAX_BODY_BYTES = 2 * 1024 * 1024  # assinatura PNG + campos
+BATCH_FAILED = "Lote recusado."
+
+# -------------- Utilidades -----------------
+def str_field(body: dict, name: str) -> Optional[str]:
+    """Campo de texto opcional do JSON; outro tipo é erro do cliente (400)."""
+    value = body.get(name)
+    if value is not None and not isinstance(value, str):
+        raise ValueError(f"Parâmetro '{name}' deve ser texto.")
+    return value or None
+
+def decode_signature(value: Optional[str]) -> Optional[bytes]:
+    """Aceita PNG em base64, com ou sem prefixo data URL."""
+    if not value:
+        return None
+    if not isinstance(value, str):
+        raise ValueError("Assinatura inválida.")
+    if value.startswith("data:"):
+        value = value.split(",", 1)[-1]
+    try:
+        return base64.b64decode(value, validate=True)
+    except Exception:
+        raise ValueError("Assinatura inválida.")
+
+def parse_due(value: Optional[str]) -> Optional[datetime.datetime]:
+    """'HH:MM' de hoje (como o 'Hoje 18:00' do Streamlit) ou sem prazo."""
+    if not value:
+        return None
+    try:
+        t = datetime.time.fromisoformat(value)
+    except (ValueError, TypeError):
+        raise ValueError("Prazo inválido (use HH:MM).")
+    return datetime.datetime.combine(datetime.date.today(), t)
+
+def parse_key(value) -> int:
+    if value is None or not str(value).isdigit():
+        raise ValueError("Parâmetro 'key' inválido.")
+    return int(value)
+
+def parse_keys(value) -> List[int]:
+    """Lote: lista JSON ou texto "12,13,14" (query string)."""
+    items = value.split(",") if isinstance(value, str) else value
+    if not isinstance(items, list) or not items:
+        raise ValueError("Parâmetro 'keys' inválido.")
+    return [parse_key(k) for k in items]
+
+def space_info(key_number: int) -> Optional[dict]:
+    row = db.get_space(key_number)
+    if row is None:
+        return None
+    return {"key_number": int(row["key_number"]), "room_name": row["room_name"],
+            "location": row["location"] or "", "category": row["category"] or "Sala"}
+
+# -------------- Operações ------------------
+def api_validate(action: str, key_number: int, token: Optional[str], pid: Optional[str]) -> Tuple[bool, dict]:
+    """Mesmas regras das telas públicas do Streamlit, sem consumir o token."""
+    if action not in ("retirar", "devolver"):
+        return False, {"error": "Ação inválida."}
+    if not db.space_exists_and_active(key_number):
+        return False, {"error": "Chave não cadastrada/ativa."}
+    out = {"action": action, "key": space_info(key_number)}
+    if action == "devolver":
+        if token:
+            ok, msg = db.validate_qr_token(token, "devolver", key_number, None)
+            if not ok:
+                return False, {"error": msg}
+        out["open_checkout"] = db.has_open_checkout(key_number)
+        return True, out
+    if not token:
+        return False, {"error": "Token ausente. Solicite um novo QR ao gestor."}
+    ok, msg = db.validate_qr_token(token, "retirar", key_number, pid)
+    if not ok:
+        return False, {"error": msg}
+    prow, msg = db.qr_checkout_person(key_number, pid)
+    if prow is None:
+        return False, {"error": msg}
+    out["person"] = {"name": prow["name"], "id_code": prow["id_code"] or "", "phone": prow["phone"] or ""}
+    return True, out
+
+def api_validate_batch(action: str, keys: List[int], token: Optional[str], pid: Optional[str]) -> Tuple[bool, dict]:
+    """Como api_validate, para um QR de lote: o token vale para exatamente essas chaves."""
+    if action not in ("retirar", "devolver"):
+        return False, {"error": "Ação inválida."}
+    if action == "retirar" and not token:
+        return False, {"error": "Token ausente. Solicite um novo QR ao gestor."}
+    if token:
+        ok, msg = db.validate_qr_token(token, action, keys, pid if action == "retirar" else None)
+        if not ok:
+            return False, {"error": msg}
+    infos = []
+    for k in keys:
+        info = space_info(k) if db.space_exists_and_active(k) else None
+        if info is None:
+            return False, {"error": f"Chave {k} não cadastrada/ativa."}
+        infos.append(info)
+    out = {"action": action, "keys": infos}
+    if action == "retirar":
+        for k in keys:
+            prow, msg = db.qr_checkout_person(k, pid)
+            if prow is None:
+                return False, {"error": f"Chave {k}: {msg}"}
+        out["person"] = {"name": prow["name"], "id_code": prow["id_code"] or "", "phone": prow["phone"] or ""}
+    return True, out
+
+def _batch_out(ok: bool, results: List[dict]) -> dict:
+    out = {"results": results}
+    if not ok:
+        # o motivo da recusa, não o "não gravada" das chaves que só caíram junto
+        out["error"] = next((r["error"] for r in results if r["error"] != db.BATCH_ABORTED), BATCH_FAILED)
+    return out
+
+def api_checkin(body: dict) -> Tuple[bool, dict]:
+    if "keys" in body:
+        ok, results = db.qr_batch_checkin(parse_keys(body.get("keys")), str_field(body, "token"),
+                                          decode_signature(body.get("signature")))
+        return ok, _batch_out(ok, results)
+    ok, msg = db.qr_checkin(parse_key(body.get("key")), str_field(body, "token"),
+                            decode_signature(body.get("signature")))
+    return ok, ({"protocol": msg} if ok else {"error": msg})
+
+def api_checkout(body: dict) -> Tuple[bool, dict]:
+    pid = str_field(body, "pid")
+    if not pid:
+        raise ValueError("Parâmetro 'pid' ausente.")
+    if "keys" in body:
+        ok, results = db.qr_batch_checkout(parse_keys(body.get("keys")), pid, str_field(body, "token"),
+                                           parse_due(str_field(body, "due")), decode_signature(body.get("signature")))
+        return ok, _batch_out(ok, results)
+    ok, msg = db.qr_checkout(parse_key(body.get("key")), pid, str_field(body, "token"),
+                             parse_due(str_field(body, "due")), decode_signature(body.get("signature")))
+    return ok, ({"protocol": msg} if ok else {"error": msg})
+
+# -------------- HTTP -----------------------
+class ScanHandler(BaseHTTPRequestHandler):
+    server_version = "GuaritaScan/1.0"
+
+    def _send(self, status: int, payload: bytes, ctype: str):
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(payload)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _json(self, status: int, obj: dict):
+        self._send(status, json.dumps(obj, ensure_ascii=False).encode("utf-8"), "application/json; charset=utf-8")
+
+    def _result(self, ok: bool, data: dict):
+        # 200 quando a operação vale; 422 quando a regra de negócio recusa (token, chave em uso...)
+        self._json(200 if ok else 422, {"ok": ok, **data})
+
+    def _read_json(self) -> dict:
+        n = int(self.headers.get("Content-Length") or 0)
+        if n <= 0 or n > MAX_BODY_BYTES:
+            raise ValueError("Corpo da requisição ausente ou grande demais.")
+        body = json.loads(self.rfile.read(n).decode("utf-8"))
+        if not isinstance(body, dict):
+            raise ValueError("JSON deve ser um objeto.")
+        return body
+
+    def _guard(self, handler):
+        """Erro inesperado vira JSON (o cliente nunca fica sem resposta); banco ocupado = 503."""
+        try:
+            handler()
+        except sqlite3.OperationalError as e:
+            msg = str(e).lower()
+            if "locked" in msg or "busy" in msg:
+                return self._json(503, {"ok": False, "error": "Banco ocupado. Tente novamente."})
+            self.log_error("Erro no banco: %r", e)
+            return self._json(500, {"ok": False, "error": "Erro interno."})
+        except Exception as e:
+            self.log_error("Erro interno: %r", e)
+            return self._json(500, {"ok": False, "error": "Erro interno."})
+
+    def do_GET(self):
+        self._guard(self._get)
+
+    def do_POST(self):
+        self._guard(self._post)
+
+    def _get(self):
+        url = urlparse(self.path)
+        if url.path in ("/", "/index.html"):
+            with open(os.path.join(STATIC_DIR, "scan.html"), "rb") as f:
+                return self._send(200, f.read(), "text/html; charset=utf-8")
+        if url.path == "/api/changes":
+            # cursor para painéis: só chave/entidade, sem ids internos
+            q = {k: v[0] for k, v in parse_qs(url.query).items()}
+            since = q.get("since", "0")
+            if not since.isdigit():
+                return self._json(400, {"ok": False, "error": "Parâmetro 'since' inválido."})
+            cursor, df, reset = db.changes_since(int(since))
+            df = df.astype(object).where(df.notna(), None)  # NaN -> null no JSON
+            changes = df[["seq", "at", "entity", "op", "key_number"]].to_dict("records")
+            # reset: o cursor é anterior à poda do change_log; o cliente recarrega tudo e segue de "cursor"
+            return self._json(200, {"ok": True, "cursor": cursor, "reset": reset, "changes": changes})
+        if url.path == "/api/validate":
+            q = {k: v[0] for k, v in parse_qs(url.query).items()}
+            try:
+                if q.get("keys"):
+                    return self._result(*api_validate_batch(q.get("action", ""), parse_keys(q["keys"]),
+                                                             q.get("token") or None, q.get("pid") or None))
+                return self._result(*api_validate(q.get("action", ""), parse_key(q.get("key")),
+                                                   q.get("token") or None, q.get("pid") or None))
+            except ValueError as e:
+                return self._json(400, {"ok": False, "error": str(e)})
+        self._json(404, {"ok": False, "error": "Não encontrado."})
+
+    def _post(self):
+        routes = {"/api/checkin": api_checkin, "/api/checkout": api_checkout}
+        fn = routes.get(urlparse(self.path).path)
+        if fn is None:
+            return self._json(404, {"ok": False, "error": "Não encontrado."})
+        try:
+            return self._result(*fn(self._read_json()))
+        except (ValueError, json.JSONDecodeError) as e:
+            return self._json(400, {"ok": False, "error": str(e)})
+
+def make_server(host: str = "0.0.0.0", port: int = 8502) -> ThreadingHTTPServer:
+    db.init_db()
+    httpd = ThreadingHTTPServer((host, port), ScanHandler)
+    httpd.daemon_threads = True
+    return httpd
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Serviço leve de QR (retirada/devolução) da Guarita.")
+    ap.add_argument("--host", default=os.getenv("SCAN_HOST", "0.0.0.0"))
+    ap.add_argument("--port", type=int, default=int(os.getenv("SCAN_PORT", "8502")))
+    ap.add_argument("--db", default=None, help="Arquivo SQLite (padrão: DB_PATH do ambiente).")
+    args = ap.parse_args()
+    if args.db:
+        db.DB_PATH = args.db
+    httpd = make_server(args.host, args.port)
+    print(f"Scan API em http://{args.host}:{args.port}/ (DB: {db.DB_PATH})")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
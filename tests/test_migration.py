@@ -0,0 +1,51 @@
+import os, sys, sqlite3
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import db
+
+PERSON_UID = "2b5027f4-39b5-48d2-873e-716bed71e651"
+TX_UIDS = ["36406b88-54e4-4e9b-aec3-1d543f9d3cc1", "0b58b371-e17b-4bd0-86cb-5f8726dcb6c2"]
+
+def make_baseline_db(path: str):
+    """Banco no esquema original (ids UUID em TEXT), com uma pessoa, autorização e duas movimentações."""
+    c = sqlite3.connect(path)
+    c.executescript("""
+      CREATE TABLE spaces(key_number INTEGER PRIMARY KEY, room_name TEXT NOT NULL, location TEXT,
+                          is_active INTEGER DEFAULT 1, category TEXT DEFAULT 'Sala');
+      CREATE TABLE persons(id TEXT PRIMARY KEY, name TEXT NOT NULL, id_code TEXT, phone TEXT, is_active INTEGER DEFAULT 1);
+      CREATE TABLE transactions(id TEXT PRIMARY KEY, key_number INTEGER NOT NULL, taken_by_name TEXT NOT NULL,
+                                taken_by_id TEXT, taken_phone TEXT, checkout_time TEXT NOT NULL, due_time TEXT,
+                                checkin_time TEXT, status TEXT, signature_out BLOB, signature_in BLOB);
+      CREATE TABLE authorizations(id TEXT PRIMARY KEY, key_number INTEGER NOT NULL, memo_number TEXT,
+                                  valid_from TEXT, valid_to TEXT, created_at TEXT);
+      CREATE TABLE authorization_people(id TEXT PRIMARY KEY, authorization_id TEXT NOT NULL, person_id TEXT NOT NULL);
+      CREATE TABLE qr_tokens(token TEXT PRIMARY KEY, action TEXT NOT NULL, key_number INTEGER NOT NULL,
+                             person_id TEXT, expires_at TEXT NOT NULL, used_at TEXT, created_at TEXT NOT NULL);
+    """)
+    c.execute("INSERT INTO spaces(key_number, room_name) VALUES(1, 'Sala 1')")
+    c.execute("INSERT INTO persons VALUES(?, 'Ana', '1000', '', 1)", (PERSON_UID,))
+    c.execute("INSERT INTO authorizations VALUES('a-1', 1, 'M1', NULL, NULL, '2026-01-01T08:00:00')")
+    c.execute("INSERT INTO authorization_people VALUES('ap-1', 'a-1', ?)", (PERSON_UID,))
+    c.execute("""INSERT INTO transactions VALUES(?, 1, 'Ana', '1000', '', '2026-01-01T08:00:00', NULL,
+                 '2026-01-01T09:00:00', 'DEVOLVIDA', NULL, NULL)""", (TX_UIDS[0],))
+    c.execute("""INSERT INTO transactions VALUES(?, 1, 'Ana', '1000', '', '2026-01-02T08:00:00', NULL,
+                 NULL, 'EM_USO', NULL, NULL)""", (TX_UIDS[1],))
+    c.commit()
+    c.close()
+
+def test_migration_twice_keeps_original_uuids(tmp_path):
+    path = str(tmp_path / "baseline.db")
+    make_baseline_db(path)
+    db.init_db(path)
+    # segundo processo que viu o esquema antigo antes de pegar o lock, e chamada repetida
+    for _ in range(2):
+        c = db._connect(path)
+        db._migrate_int_ids(c)
+        c.close()
+
+    c = sqlite3.connect(path)
+    assert [r[0] for r in c.execute("SELECT uid FROM persons")] == [PERSON_UID]
+    assert sorted(r[0] for r in c.execute("SELECT uid FROM transactions")) == sorted(TX_UIDS)
+    assert c.execute("""SELECT p.uid FROM authorization_people ap
+                        JOIN persons p ON p.id = ap.person_id""").fetchall() == [(PERSON_UID,)]
+    assert c.execute("PRAGMA foreign_key_check").fetchall() == []
+    c.close()
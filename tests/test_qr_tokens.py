@@ -0,0 +1,53 @@
+import os, sys, sqlite3
+import pytest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import db
+
+@pytest.fixture
+def fresh_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "keys.db"))
+    db.init_db()
+    for k in (1, 2, 3):
+        db.add_space(k, f"Sala {k}")
+    db.add_person("Ana", "1000", "")
+    return db.list_persons().iloc[0]["uid"]
+
+def _locked(*args):
+    raise sqlite3.OperationalError("database is locked")
+
+def test_qr_checkin_releases_token_when_operation_raises(fresh_db, monkeypatch):
+    assert db.open_checkout(1, "Ana", "1000", "", None, None)[0]
+    token, _ = db.create_qr_token("devolver", 1, None)
+    with monkeypatch.context() as m:
+        m.setattr(db, "do_checkin", _locked)
+        with pytest.raises(sqlite3.OperationalError):
+            db.qr_checkin(1, token, None)
+    ok, msg = db.qr_checkin(1, token, None)  # a nova tentativa vale
+    assert ok, msg
+    assert db.qr_checkin(1, token, None) == (False, "Token já utilizado.")
+
+def test_qr_checkout_releases_token_when_operation_raises(fresh_db, monkeypatch):
+    token, _ = db.create_qr_token("retirar", 1, fresh_db)
+    with monkeypatch.context() as m:
+        m.setattr(db, "open_checkout", _locked)
+        with pytest.raises(sqlite3.OperationalError):
+            db.qr_checkout(1, fresh_db, token, None, None)
+    ok, msg = db.qr_checkout(1, fresh_db, token, None, None)
+    assert ok, msg
+
+def test_qr_batch_flows_release_token_when_operation_raises(fresh_db, monkeypatch):
+    token, _ = db.create_qr_token("retirar", [2, 3], fresh_db)
+    with monkeypatch.context() as m:
+        m.setattr(db, "batch_checkout", _locked)
+        with pytest.raises(sqlite3.OperationalError):
+            db.qr_batch_checkout([2, 3], fresh_db, token, None, None)
+    ok, results = db.qr_batch_checkout([2, 3], fresh_db, token, None, None)
+    assert ok and all(r["ok"] for r in results)
+
+    token, _ = db.create_qr_token("devolver", [2, 3], None)
+    with monkeypatch.context() as m:
+        m.setattr(db, "batch_checkin", _locked)
+        with pytest.raises(sqlite3.OperationalError):
+            db.qr_batch_checkin([2, 3], token, None)
+    ok, results = db.qr_batch_checkin([2, 3], token, None)
+    assert ok and all(r["ok"] for r in results)